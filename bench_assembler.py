@@ -0,0 +1,195 @@
+"""Compare the speed of assembled code with code compiled from Python source
+
+Each benchmark pairs a node tree with the Python source of an equivalent
+function ``f``, and the arguments to call it with.  For each one, the tree is
+assembled into a function with the same arguments, and both functions are
+timed, along with their instruction counts and stack sizes.  Benchmarks whose
+assembled code is slower than the compiled code (by more than the threshold
+ratio) are flagged with a ``*``.  Run ``python bench_assembler.py --help`` for
+the options; any other arguments select benchmarks by name.
+"""
+
+import sys
+from types import CodeType, FunctionType
+from optparse import OptionParser
+from timeit import default_timer as timer
+from peak.util.assembler import *
+from peak.util.assembler import iter_code
+
+benchmarks = []
+
+def benchmark(name, source, body, *calls):
+    """Add a benchmark of `body`, equivalent to `source`, called with `calls`"""
+    benchmarks.append((name, source, body, calls))
+
+
+benchmark('if_chain', """
+def f(x):
+    if x < 0:
+        return -1
+    elif x == 0:
+        return 0
+    return 1
+""", Suite([
+    If(Compare(Local('x'), [('<', Const(0))]), Return(Const(-1))),
+    If(Compare(Local('x'), [('==', Const(0))]), Return(Const(0))),
+    Return(Const(1)),
+]), (-5,), (0,), (5,))
+
+benchmark('chained_compare', """
+def f(x):
+    return 0 < x < 10
+""", Return(
+    Compare(Const(0), [('<', Local('x')), ('<', Const(10))])
+), (-5,), (5,), (15,))
+
+benchmark('and_or', """
+def f(x, y, z):
+    if x and y or z:
+        return 1
+    return 2
+""", Suite([
+    If(Or([And([Local('x'), Local('y')]), Local('z')]), Return(Const(1))),
+    Return(Const(2)),
+]), (1, 1, 0), (1, 0, 1), (0, 1, 0))
+
+benchmark('for_loop', """
+def f(seq):
+    total = 0
+    for item in seq:
+        total += item
+    return total
+""", Suite([
+    Const(0), LocalAssign('total'),
+    For(Local('seq'), LocalAssign('item'),
+        Suite([Local('total'), Local('item'), Code.INPLACE_ADD,
+            LocalAssign('total')])
+    ),
+    Return(Local('total')),
+]), (list(range(100)),))
+
+benchmark('list_comp', """
+def f(seq):
+    return [item * 2 for item in seq]
+""", Return(ListComp(
+    For(Local('seq'), LocalAssign('item'),
+        LCAppend(Suite([Local('item'), Const(2), Code.BINARY_MULTIPLY]))
+    )
+)), (list(range(100)),))
+
+benchmark('try_except', """
+def f(d, k):
+    try:
+        return d[k]
+    except KeyError:
+        return None
+""", TryExcept(
+    Return(Suite([Local('d'), Local('k'), Code.BINARY_SUBSCR])),
+    [(Global('KeyError'), Return(None))]
+), ({1: 2}, 1), ({}, 1))
+
+benchmark('closure', """
+def f(x):
+    def add(y):
+        return x + y
+    return add(1)
+""", Suite([
+    Function(Return(Suite([Local('x'), Local('y'), Code.BINARY_ADD])), 'add',
+        ['y']),
+    LocalAssign('add'),
+    Return(Call(Local('add'), [Const(1)])),
+]), (1,), (2,))
+
+
+def build(name, source, body):
+    """Return the ``(compiled, assembled)`` versions of a benchmark function"""
+    namespace = {}
+    exec(compile(source, '<%s>' % name, 'exec'), namespace)
+    compiled = namespace['f']
+    c = Code.from_function(compiled)
+    c(body)
+    return compiled, FunctionType(c.code(), namespace)
+
+def count_instructions(code):
+    """Count the instructions in `code`, and in code objects nested in it"""
+    count = len(list(iter_code(code.co_code)))
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            count += count_instructions(const)
+    return count
+
+def best_time(func, calls, number, repeat):
+    """Return the best of `repeat` times to make all `calls` `number` times"""
+    best = None
+    for r in range(repeat):
+        started = timer()
+        for n in range(number):
+            for args in calls:
+                func(*args)
+        elapsed = timer() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(names=(), number=10000, repeat=3):
+    """Run the named benchmarks (or all of them), returning a row for each
+
+    Each row is a tuple of the benchmark's name, followed by the compiled and
+    assembled functions' times, instruction counts, and stack sizes.
+    """
+    rows = []
+    for name, source, body, calls in benchmarks:
+        if names and name not in names:
+            continue
+        compiled, assembled = build(name, source, body)
+        for args in calls:
+            if compiled(*args) != assembled(*args):
+                raise AssertionError("Different results", name, args)
+        ccode, acode = compiled.__code__, assembled.__code__
+        rows.append((name,
+            best_time(compiled, calls, number, repeat),
+            best_time(assembled, calls, number, repeat),
+            count_instructions(ccode), count_instructions(acode),
+            ccode.co_stacksize, acode.co_stacksize,
+        ))
+    return rows
+
+def report(rows, threshold=1.05, out=sys.stdout):
+    """Write a table of `rows`, flagging any that are slower than `threshold`
+
+    Returns the number of benchmarks flagged.
+    """
+    flagged = 0
+    out.write("%-16s %9s %9s %6s %7s %7s\n" % (
+        'benchmark', 'compiled', 'assembled', 'ratio', 'instrs', 'stack'
+    ))
+    for name, ctime, atime, ccount, acount, cstack, astack in rows:
+        ratio = atime / ctime
+        flag = ' '
+        if ratio > threshold:
+            flag = '*'
+            flagged += 1
+        out.write("%-16s %9.4f %9.4f %5.2f%s %3d/%-3d %3d/%-3d\n" % (
+            name, ctime, atime, ratio, flag, ccount, acount, cstack, astack
+        ))
+    if flagged:
+        out.write("\n%d benchmark(s) slower than compiled code\n" % flagged)
+    return flagged
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("-n", "--number", type="int", default=10000,
+        help="times to make each benchmark's calls, per timing")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+        help="timings to take the best of")
+    parser.add_option("-t", "--threshold", type="float", default=1.05,
+        help="slowdown ratio (assembled/compiled) to flag")
+    options, names = parser.parse_args(argv)
+    known = [name for name, source, body, calls in benchmarks]
+    for name in names:
+        if name not in known:
+            parser.error("unknown benchmark: %s" % name)
+    report(run(names, options.number, options.repeat), options.threshold)
+
+if __name__ == '__main__':
+    main()
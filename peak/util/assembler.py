@@ -1,16 +1,21 @@
 from array import array
 from dis import *
-from types import CodeType
+from types import CodeType, GeneratorType
 from peak.util.symbols import Symbol
 from peak.util.decorators import decorate_assignment, decorate
-import sys
+import sys, weakref, threading
+from bisect import bisect_left, bisect_right
+from itertools import repeat
 
 __all__ = [
     'Code', 'Const', 'Return', 'Global', 'Local', 'Call', 'const_value',
     'NotAConstant', 'Label', 'fold_args', 'nodetype', 'Node', 'Pass',
     'Compare', 'And', 'Or', 'Getattr', 'TryExcept', 'TryFinally', 'Suite',
     'LocalAssign', 'UnpackSequence', 'For', 'If', 'YieldStmt', 'Function',
-    'ListComp', 'LCAppend',
+    'ListComp', 'LCAppend', 'Interner', 'sequence', 'LazyFunction',
+    'TieredFunction', 'Specialize', 'Profile', 'source_node', 'CodeService',
+    'Slot', 'Template', 'noinline', 'Save', 'Pipeline', 'UncheckedCode',
+    'verify', 'BuildGraph',
 ]
 
 opcode = {}
@@ -126,6 +131,15 @@ class Node(tuple):
     __slots__ = []
     __hash__ = tuple.__hash__
 
+    def __emit__(self, code):
+        """Generate code, or return a generator of child targets to generate"""
+        return self(code)
+
+def sequence(*targets):
+    """Return a generator that yields `targets`, for ``Code`` to generate"""
+    for ob in targets:
+        yield ob
+
 def nodetype(*mixins, **kw):
 
     def callback(frame, name, func, old_locals):
@@ -133,6 +147,9 @@ def nodetype(*mixins, **kw):
             result = func(*args, **kw)
             if type(result) is tuple:
                 return tuple.__new__(cls, (cls,)+result)
+            elif type(result) is GeneratorType:
+                # called with a code object: generate the children now
+                return ('code' in kw and kw['code'] or args[-1])(result)
             else:
                 return result
 
@@ -142,6 +159,12 @@ def nodetype(*mixins, **kw):
             return r
 
         def __call__(self, code):
+            result = func(*(self[1:]+(code,)))
+            if type(result) is GeneratorType:
+                return code(result)
+            return result
+
+        def __emit__(self, code):
             return func(*(self[1:]+(code,)))
 
         import inspect
@@ -150,7 +173,7 @@ def nodetype(*mixins, **kw):
         d = dict(
             __new__ = __new__, __repr__ = __repr__, __doc__=func.__doc__,
             __module__ = func.__module__, __args__ = args, __slots__ = [],
-            __call__ = __call__
+            __call__ = __call__, __emit__ = __emit__
         )
         for p,a in enumerate(args[:-1]):    # skip 'code' argument
             if isinstance(a,str):
@@ -183,7 +206,7 @@ nodetype()
 def Return(value=None, code=None):
     if code is None:
         return value,
-    return code(value, Code.RETURN_VALUE)
+    return sequence(value, Code.RETURN_VALUE)
 
 class _Pass(Symbol):
     def __call__(self, code=None):
@@ -200,7 +223,10 @@ def Getattr(ob, name, code=None):
         return Call(Const(getattr), [ob, name])
     if code is None:
         return fold_args(Getattr, ob, name)
-    code(ob)
+    return gen_getattr(code, ob, name)
+
+def gen_getattr(code, ob, name):
+    yield ob
     code.LOAD_ATTR(name)
 
 nodetype()
@@ -214,26 +240,249 @@ def Call(func, args=(),kwargs=(), star=None,dstar=None, fold=True, code=None):
         else:
             return data
 
-    code(func, *args)
+    if code.inline_budget is not None and not (kwargs or star or dstar):
+        nested = None
+        if type(func) is Function:
+            nested = assemble_inlinable(code, func)
+        callee = inline_target(code, func, len(args), nested)
+        if callee is not None:
+            return gen_inline(code, args, *callee)
+        elif nested is not None:
+            # Make the function from the code we have, instead of generating
+            # the body again (which a body with labels couldn't survive)
+            func = lambda code, f=func: gen_function(code, nested, *f[1:])
+    return gen_call(code, func, args, kwargs, star, dstar)
+
+def gen_call(code, func, args, kwargs, star, dstar):
+    yield func
+    for arg in args:
+        yield arg
     for k,v in kwargs:
-        code(k,v)
+        yield k
+        yield v
 
     argc = len(args)
     kwargc = len(kwargs)
 
     if star:
+        yield star
         if dstar:
-            code(star, dstar)
-            return code.CALL_FUNCTION_VAR_KW(argc, kwargc)
+            yield dstar
+            code.CALL_FUNCTION_VAR_KW(argc, kwargc)
         else:
-            code(star)
-            return code.CALL_FUNCTION_VAR(argc, kwargc)
+            code.CALL_FUNCTION_VAR(argc, kwargc)
     else:
         if dstar:
-            code(dstar)
-            return code.CALL_FUNCTION_KW(argc, kwargc)
+            yield dstar
+            code.CALL_FUNCTION_KW(argc, kwargc)
+        else:
+            code.CALL_FUNCTION(argc, kwargc)
+
+def noinline(func):
+    """Mark Python function `func` as never to be inlined by ``Call()``"""
+    func.__noinline__ = True
+    return func
+
+def assemble_inlinable(code, func):
+    """Return nested code for ``Function()`` node `func`, if it's inlinable
+
+    None is returned if `code` doesn't use fast locals, or if `func` uses
+    defaults that aren't pure, or argument forms that can't be inlined.
+    """
+    body, name, args, var, kw, defaults = func[1:]
+    if not code.co_flags & CO_OPTIMIZED or var or kw or not pure(defaults):
+        return None
+    for arg in args:
+        if not isinstance(arg, basestring):
+            return None
+    c = code.nested(name, args)
+    c.scope_assignments = assignments(body)
+    c(body)
+    if c.stack_size is not None:
+        c.return_()
+    return c
+
+def inline_target(code, func, nargs, nested=None):
+    """Return ``(callee, defaults, shared)`` if `func` can be inlined
+
+    `func` must be a ``Const()`` of a Python function, or a ``Function()``
+    node (whose body has been generated in `nested`), whose code is within
+    `code`'s ``inline_budget``, takes `nargs` positional arguments (or fewer,
+    with defaults), and uses no blocks, closures, or other frame-specific
+    features.  It also mustn't read any of its local variables before
+    assigning them, since the inlined variables keep their values from one
+    call to the next.  `shared` is true if the callee runs with the caller's
+    globals and can read its locals.
+    """
+    if not code.co_flags & CO_OPTIMIZED:
+        return None
+    t = type(func)
+    if t is Const:
+        f = func.value
+        if type(f) is not function or getattr(f, '__noinline__', False):
+            return None
+        if getattr(f, CLOSURE):
+            return None
+        callee = getattr(f, CODE)
+        defaults = list(map(Const, getattr(f, DEFAULTS) or ()))
+        shared = False
+    elif t is Function and nested is not None:
+        callee = nested.code()
+        defaults = list(func.defaults)
+        shared = True
+    else:
+        return None
+
+    required = callee.co_argcount - len(defaults)
+    if not required <= nargs <= callee.co_argcount:
+        return None
+    if callee.co_flags & (CO_VARARGS|CO_VARKEYWORDS|CO_GENERATOR):
+        return None
+    if callee.co_freevars or callee.co_cellvars:
+        return None
+    if getattr(callee, 'co_kwonlyargcount', 0):
+        return None
+    if len(callee.co_code) > code.inline_budget:
+        return None
+    for start, op, arg, jump, end in iter_code(callee.co_code):
+        if op in uninlinable_ops or op in global_ops and not shared:
+            return None
+    if reads_unassigned(callee):
+        return None
+    return callee, defaults[nargs-required:], shared
+
+def reads_unassigned(callee):
+    """Might `callee` read one of its local variables before assigning it?
+
+    Arguments are assigned on entry, and locals that `callee` never assigns
+    don't count (they're the caller's, if the callee is inlined).  Jumps are
+    followed, so a read is only safe if the variable has been assigned on
+    every path to it; loops are checked conservatively.
+    """
+    written = {}
+    for start, op, arg, jump, end in iter_code(callee.co_code):
+        if (op==STORE_FAST or op==DELETE_FAST) and arg >= callee.co_argcount:
+            written[arg] = True
+    if not written:
+        return False
+    states = definitely_assigned(callee.co_code)
+    for start, op, arg, jump, end in iter_code(callee.co_code):
+        if start not in states:
+            continue    # unreachable
+        assigned = states[start]
+        if op==LOAD_FAST and arg in written and arg not in assigned:
+            return True
+        elif op==DELETE_FAST:
+            return True     # (even if assigned, it isn't afterwards)
+        elif jump is not None and jump <= start:
+            # loop: its start mustn't expect anything more
+            for v in states[jump]:
+                if v not in assigned:
+                    return True
+    return False
+
+def definitely_assigned(codestring, assigned=()):
+    """Map reachable offsets in `codestring` to the fast locals assigned there
+
+    Each offset (including the end of the code, if execution can run into
+    it) maps to a dictionary whose keys are the numbers of the locals that
+    have been assigned on every path to it, starting with those in `assigned`.
+    Only forward jumps are followed.
+    """
+    states = {}
+    here = dict.fromkeys(assigned)
+    for start, op, arg, jump, end in iter_code(codestring):
+        if start in states:
+            if here is None:
+                here = states[start]
+            else:
+                here = dict.fromkeys([v for v in here if v in states[start]])
+        if here is None:
+            continue    # unreachable
+        states[start] = here
+        if op==STORE_FAST:
+            here = here.copy()
+            here[arg] = True
+        elif op==DELETE_FAST and arg in here:
+            here = here.copy()
+            del here[arg]
+        if jump is not None and jump > start:
+            if jump in states:
+                there = states[jump]
+                states[jump] = dict.fromkeys([v for v in here if v in there])
+            else:
+                states[jump] = here
+        if op in terminal_ops:
+            here = None
+    if here is not None:
+        end = len(codestring)
+        if end in states:
+            here = dict.fromkeys([v for v in here if v in states[end]])
+        states[end] = here
+    return states
+
+def gen_inline(code, args, callee, defaults, shared):
+    """Generate the body of `callee` in place of calling it with `args`
+
+    The arguments are stored in new local variables, named for the callee's
+    locals and the offset of the inlined code.  Each return becomes a jump to
+    the end of the inlined code, unless nothing reachable follows it.
+    """
+    for arg in tuple(args) + tuple(defaults):
+        yield arg
+
+    site = code.here()
+    varnames = callee.co_varnames
+    written = {}
+    for start, op, arg, jump, end in iter_code(callee.co_code):
+        if op==STORE_FAST or op==DELETE_FAST:
+            written[arg] = True
+    local = {}
+    for posn, name in enumerate(varnames):
+        if posn < callee.co_argcount or posn in written or not shared:
+            local[posn] = '%s@%d' % (name, site)
+    for posn in range(callee.co_argcount-1, -1, -1):
+        code.STORE_FAST(local[posn])
+
+    labels = {}
+    for start, op, arg, jump, end in iter_code(callee.co_code):
+        if jump is not None and jump not in labels:
+            labels[jump] = Label()
+    done = Label()
+
+    for start, op, arg, jump, end in iter_code(callee.co_code):
+        if start in labels:
+            labels[start](code)
+        if code.stack_size is None:
+            continue    # unreachable
+        name = opname[op]
+        if op==RETURN_VALUE:
+            for target in labels:
+                if target > start and labels[target].backpatches:
+                    done.JUMP_FORWARD(code)
+                    break
+            else:
+                break   # the rest of the callee is unreachable
+        elif jump is not None:
+            getattr(labels[jump], name)(code)
+        elif op in hasconst:
+            code.LOAD_CONST(callee.co_consts[arg])
+        elif op in hasname:
+            getattr(code, name)(callee.co_names[arg])
+        elif op in haslocal:
+            if arg in local:
+                getattr(code, name)(local[arg])
+            else:
+                code(Local(varnames[arg]))  # caller's variable
+        elif op in hascompare:
+            code.COMPARE_OP(cmp_op[arg])
+        elif op in call_ops:
+            getattr(code, name)(arg & 255, arg >> 8)
+        elif op>=HAVE_ARGUMENT:
+            getattr(code, name)(arg)
         else:
-            return code.CALL_FUNCTION(argc, kwargc)
+            getattr(code, name)()
+    done(code)
 
 
 
@@ -248,40 +497,205 @@ nodetype()
 def TryExcept(body, handlers, else_=Pass, code=None):
     if code is None:
         return body, tuple(handlers), else_
+    if not handlers or body is Pass or is_const(body):
+        return sequence(body, else_)    # nothing to catch, or nothing can raise
+    return gen_try_except(code, body, handlers, else_)
+
+def gen_try_except(code, body, handlers, else_):
     okay = Label()
     done = Label()
-    code(okay.SETUP_EXCEPT, body, okay.POP_BLOCK)
+    profile = code.profile
+    if profile is not None:
+        site = TryExcept(body, handlers, else_)
+        if profile.recording:
+            base = profile.site(site, len(handlers))
+        else:
+            handlers = profile.handlers(site, handlers)
+            profile = None
+    okay.SETUP_EXCEPT(code)
+    yield body
+    okay.POP_BLOCK(code)
     if 'POP_EXCEPT' in opcode:
         code.stack_size += 3
-    for typ, handler in handlers:
+    if profile is not None:
+        profile.record_raised(code, base)
+    for n, (typ, handler) in enumerate(handlers):
         next_test = Label()
-        Compare(Code.DUP_TOP, [('exception match', typ)], code)
-        code(
-            next_test.JUMP_IF_FALSE_OR_POP,             # remove condition
-            Code.POP_TOP, Code.POP_TOP, Code.POP_TOP,   # remove exc info
-        )
+        test = Compare(Code.DUP_TOP, [('exception match', typ)])
+        if 'POP_JUMP_IF_FALSE' in opcode:
+            yield gen_branch(code, test, next_test, False)
+        else:
+            yield test
+            next_test.JUMP_IF_FALSE_OR_POP(code)    # remove condition
+        code(Code.POP_TOP, Code.POP_TOP, Code.POP_TOP)  # remove exc info
         if 'POP_EXCEPT' in opcode:
-            code(Code.POP_EXCEPT)
-        code(handler)
+            code.POP_EXCEPT()
+        if profile is not None:
+            profile.count(code, base+n)
+        yield handler
         if code.stack_size is not None:
-            code(done.JUMP_FORWARD)
-        code(next_test, Code.POP_TOP)            # remove condition
-    code(Code.END_FINALLY)
+            done.JUMP_FORWARD(code)
+        next_test(code)
+        if 'POP_JUMP_IF_FALSE' not in opcode:
+            code.POP_TOP()                      # remove condition
+    code.END_FINALLY()
     code.stack_unknown()    # force stack level to come from end of body
-    code(okay, else_, done)
+    okay(code)
+    yield else_
+    done(code)
 
 nodetype()
 def Suite(body, code=None):
     if code is None:
         if body: return tuple(body),
         return Pass
-    code(*body)
+    if code.cse is not None and code.co_flags & CO_OPTIMIZED:
+        if not code._cse_level:
+            return gen_cse_suite(code, body)
+    if code.split_budget is not None and code.co_flags & CO_OPTIMIZED:
+        return gen_split_suite(code, body)
+    if isinstance(code, StatementSizer):
+        return gen_sized_suite(code, body)
+    return sequence(*body)
+
+def gen_cse_suite(code, body):
+    body = common_subexpressions(body, code.cse, len(code.co_varnames))
+    code._cse_level += 1    # nested suites were already done
+    yield Suite(body)
+    code._cse_level -= 1
+
+# Smallest run of statements worth moving to a helper: creating and calling
+# one takes at least 14 bytes, plus 3 for each variable it shares
+min_split_size = 20
+
+def gen_split_suite(code, body):
+    budget = code.split_budget
+    sizes = statement_sizes(code, body)
+    if sum([n for n in sizes if n is not None]) <= budget:
+        yield sequence(*body)
+        return
+    chunk, size = [], 0
+    for ob, n in zip(list(body) + [Pass], sizes + [None]):
+        if n is None or chunk and size+n > budget:
+            if size >= min_split_size:
+                split_off(code, chunk)
+            elif chunk:
+                yield sequence(*chunk)
+            chunk, size = [], 0
+        if n is None:
+            yield ob
+        else:
+            chunk.append(ob)
+            size += n
+
+def statement_sizes(code, body):
+    """Return the bytecode size of each statement in `body`, or None
+
+    A statement can be split off if it contains no labels or jumps to outside
+    itself, doesn't return, yield, break, or continue, and leaves the stack as
+    it found it; None is returned for statements that can't.  Statements are
+    measured by generating them in a ``StatementSizer``, which also measures
+    the statements of any suites nested in them, so that each statement is
+    only measured once.  (The sizes are kept in the code's ``split_sizes``,
+    which code objects nested in it share.)
+    """
+    sizes = code.split_sizes
+    if sizes is None:
+        sizes = code.split_sizes = {}
+    missing = [
+        ob for ob in body if id(ob) not in sizes or sizes[id(ob)][0] is not ob
+    ]
+    if missing:
+        measurable = [ob for ob in missing if splittable(ob)]
+        trial = code.nested(cls=StatementSizer)
+        trial.split_budget = trial.interner = None
+        try:
+            trial(Suite(measurable))
+        except AssertionError:
+            pass    # statements not measured by now won't be split off
+        trial.finish()
+        for ob in measurable:
+            if sizes.get(id(ob), (None,))[0] is ob:
+                sizes[id(ob)] = ob, sizes[id(ob)][1], True
+        for ob in missing:
+            if sizes.get(id(ob), (None,))[0] is not ob:
+                sizes[id(ob)] = ob, None, True
+    result = []
+    for ob in body:
+        ob, n, checked = sizes[id(ob)]
+        if not checked:
+            if n is not None and not splittable(ob):
+                n = None
+            sizes[id(ob)] = ob, n, True
+        result.append(n)
+    return result
+
+def gen_sized_suite(code, body):
+    for ob in body:
+        level, low, start = code.stack_size, code.low, len(code.co_code)
+        blocks = len(code.blocks)
+        code.low = level
+        yield ob
+        if code.stack_size != level or code.low < level or \
+            len(code.blocks) != blocks:
+            code.sized.append((ob, code, None, None))
+        else:
+            code.sized.append((ob, code, start, len(code.co_code)))
+        code.low = min(low, code.low)
+
+def splittable(ob):
+    """Can `ob` be generated in another code object?  (i.e., no labels, etc.)
+
+    Nested functions can contain jumps, returns, and so on, but not labels or
+    other targets that can't be generated more than once.
+    """
+    todo = [(ob, False)]
+    while todo:
+        ob, nested = todo.pop()
+        t = type(ob)
+        if isinstance(ob, Node):
+            nested = nested or t in function_nodes
+            todo.extend([(kid, nested) for kid in children(ob)])
+        elif t is tuple or t is list:
+            todo.extend([(item, nested) for item in ob])
+        elif t is dict:
+            todo.extend([(item, nested) for item in ob.keys()])
+            todo.extend([(item, nested) for item in ob.values()])
+        elif ob is Pass or t is Const or t in generate_types:
+            continue
+        else:
+            name = getattr(ob, '__name__', None)
+            if name is None or getattr(Code, name, None) != ob:
+                return False
+            elif name in unsplittable_ops and not nested:
+                return False
+    return True
+
+def split_off(code, chunk):
+    """Move the statements in `chunk` to a helper function, and call it"""
+    helper = code.nested('%s_part%d' % (code.co_name, len(code.splits)+1))
+    helper(*chunk)
+    helper.return_()
+    # The helper's variables are the caller's, except for the temporaries
+    # that never outlive an expression (``ListComp()`` and compare ones);
+    # saved subexpressions and hoisted loads can be used by later statements
+    shared = lambda names: [n for n in names if not (
+        n.startswith('_[cmp') or n.startswith('_[') and n[2:-1].isdigit()
+    )]
+    helper._cells_to_frees(shared(helper.co_cellvars))
+    helper.makefree(shared(helper.co_varnames))
+    code.split_writes.extend(helper.locals_written())
+    offset = len(code.co_code)
+    make_function(code, helper.code(code))
+    code.CALL_FUNCTION(0)
+    code.POP_TOP()
+    code.splits.append((offset, helper.co_name, len(chunk)))
 
 nodetype()
 def TryFinally(body, handler, code=None):
     if code is None:
         return body, handler
-    code(
+    return sequence(
         Code.SETUP_FINALLY, body, Code.POP_BLOCK, handler, Code.END_FINALLY
     )
 
@@ -302,19 +716,470 @@ def UnpackSequence(nodes, code=None):
     if code is None:
         return tuple(nodes),
     code.UNPACK_SEQUENCE(len(nodes))
-    return code(*nodes)
+    return sequence(*nodes)
 
 
 nodetype()
 def For(iterable, assign, body=Pass, code=None):
     if code is None:
         return iterable, assign, body
+    return gen_for(code, iterable, assign, body)
+
+def gen_for(code, iterable, assign, body):
     L1, L2 = Label(), Label()
-    return code(
-        iterable, Code.GET_ITER, L1, L2.FOR_ITER, assign, body,
-        L1.JUMP_ABSOLUTE, L2
+    yield iterable
+    if code.hoist is not None and code.co_flags & CO_OPTIMIZED:
+        hoisted = loop_invariants((assign, body), code.hoist)
+        if hoisted:
+            temps = {}
+            for node in hoisted:
+                temps[node] = Local('_[%s]' % dotted_name(node))
+                yield node
+                yield LocalAssign(temps[node].name)
+            assign, body = substitute((assign, body), temps, scope_children)
+    yield sequence(
+        Code.GET_ITER, L1, L2.FOR_ITER, assign, body, L1.JUMP_ABSOLUTE, L2
     )
 
+def children(ob):
+    """Return the subtrees of a node, tuple, or list (or ``()``)"""
+    if isinstance(ob, Node):
+        return ob[1:]
+    elif type(ob) is tuple or type(ob) is list:
+        return ob
+    return ()
+
+def rebuild(ob, children):
+    """Return a node, tuple, or list like `ob`, but with new `children`"""
+    if isinstance(ob, Node):
+        return ob.__class__(*children)
+    elif type(ob) is list:
+        return list(children)
+    return tuple(children)
+
+def scope_children(ob):
+    """Like ``children()``, but nested functions have no children"""
+    if type(ob) in function_nodes:
+        return ()
+    return children(ob)
+
+def substitute(ob, replacements, children=children):
+    """Rebuild `ob`, replacing any subtrees found in `replacements`
+
+    `children` is the function used to find the subtrees of each subtree.
+    """
+    memo = {}   # id(subtree) -> rebuilt subtree
+    todo = [ob]
+    while todo:
+        node = todo[-1]
+        key = id(node)
+        if key in memo:
+            todo.pop()
+            continue
+        try:
+            memo[key] = replacements[node]
+        except (KeyError, TypeError):
+            pass
+        else:
+            todo.pop()
+            continue
+        kids = children(node)
+        missing = [kid for kid in kids if id(kid) not in memo]
+        if missing:
+            todo.extend(missing)
+            continue
+        new = [memo[id(kid)] for kid in kids]
+        memo[key] = node
+        for old, kid in zip(kids, new):
+            if old is not kid:
+                memo[key] = rebuild(node, new)
+                break
+        todo.pop()
+    return memo[id(ob)]
+
+def loop_invariants(ob, policy):
+    """Return a list of the hoistable global and attribute loads in `ob`
+
+    A ``Global`` is hoistable if ``policy(node)`` is true for it.  A
+    ``Getattr`` is hoistable if ``policy(node)`` is true, and its target is
+    either hoistable or a ``Global``.  Only the outermost hoistable loads are
+    returned, in order of first appearance.  Nested functions aren't
+    searched, since they have their own scope.
+    """
+    found = []
+    def invariant(node):
+        while type(node) is Getattr:
+            node = node.ob
+        return type(node) is Global
+    todo = [ob]
+    while todo:
+        node = todo.pop()
+        if type(node) in (Global, Getattr) and invariant(node) and policy(node):
+            if node not in found:
+                found.append(node)
+        else:
+            kids = list(scope_children(node))
+            kids.reverse()      # so they're searched in order
+            todo.extend(kids)
+    return found
+
+def dotted_name(node):
+    """Return a dotted name for a ``Global`` or ``Getattr`` chain"""
+    names = []
+    while type(node) is Getattr:
+        names.append(node.name)
+        node = node.ob
+    names.append(node.name)
+    names.reverse()
+    return '.'.join(names)
+
+nodetype()
+def Save(value, name, code=None):
+    """Generate `value`, also saving it in local variable `name`"""
+    if code is None:
+        return value, name
+    return sequence(value, Code.DUP_TOP, LocalAssign(name))
+
+def common_subexpressions(ob, policy, first=0):
+    """Rebuild `ob`, computing repeated subexpressions only once
+
+    A repeated subtree is saved in a temporary local (named ``_[#n]``, with `n`
+    counting from `first`) the first time it's evaluated, and loaded from the
+    temporary wherever it would be evaluated again later on the same path, if
+    none of the locals it uses have been assigned in between.  Only subtrees
+    that are ``pure()``, or for which ``policy(node)`` is true and whose
+    subtrees all qualify, are eligible.  Nothing is evaluated earlier, or on
+    more paths, than in the original tree.
+    """
+    saved = {}
+    CSEWalker(policy, saved).walk(ob, {})
+    if not saved:
+        return ob
+    temps = {}
+    for n, occurrence in enumerate(sorted(saved)):
+        temps[occurrence] = '_[#%d]' % (first+n)
+    return CSEWalker(policy, saved, temps).walk(ob, {})
+
+class CSEWalker(object):
+    """Walk a tree in evaluation order, tracking the values already computed
+
+    `avail` maps the ``tree_key()`` of each subtree computed on every path to
+    the current position (and not invalidated since) to the number of the
+    occurrence that computed it, and the subtree; `saved` collects the numbers
+    of the occurrences that are reused.  With `temps`, the walk returns the
+    tree rewritten to use them.  Since subtrees are matched by their keys,
+    ``Const(1)`` and ``Const(True)`` (for example) aren't interchangeable.
+    """
+
+    def __init__(self, policy, saved, temps=None):
+        self.policy = policy
+        self.saved = saved
+        self.temps = temps
+        self.count = 0
+        self.memo = {}
+        self.keys = {}  # id(subtree) -> (subtree, key or None if unhashable)
+
+    def key(self, ob):
+        """Return ``tree_key(ob)``, or ``None`` if `ob` has unhashable leaves"""
+        try:
+            return self.keys[id(ob)][1]
+        except KeyError:
+            pass
+        try:
+            key = tree_key(ob)
+        except TypeError:
+            key = None
+        self.keys[id(ob)] = ob, key
+        return key
+
+    def stable(self, ob):
+        """Can `ob`'s value be computed once, and reused?"""
+        key = self.key(ob)
+        if key is None:
+            return False
+        elif key in self.memo:
+            return self.memo[key]
+        t = type(ob)
+        result = pure(ob) or (
+            t is tuple or t is list or isinstance(ob, Node) and
+            not opaque(ob) and bool(self.policy(ob))
+        ) and not [kid for kid in children(ob) if not self.stable(kid)]
+        self.memo[key] = result
+        return result
+
+    def walk(self, ob, avail):
+        t = type(ob)
+        if t is Local or t is Const or not (isinstance(ob, Node) or
+            t is tuple or t is list
+        ):
+            if opaque(ob):
+                avail.clear()
+            return ob
+        elif t is LocalAssign:
+            kill(avail, [ob.name])
+            return ob
+        if t is not tuple and t is not list and not is_const(ob) and \
+            self.stable(ob):
+            key = self.key(ob)
+            if key in avail:
+                occurrence = avail[key][0]
+                self.saved[occurrence] = True
+                return self.temps and Local(self.temps[occurrence])
+            new = self.descend(ob, avail)
+            self.count += 1
+            occurrence = self.count
+            avail[key] = occurrence, ob
+            if self.temps and occurrence in self.saved:
+                return Save(new, self.temps[occurrence])
+            return new
+        return self.descend(ob, avail)
+
+    def descend(self, ob, avail):
+        t = type(ob)
+        walk = self.walk
+        kids = children(ob)
+        if t is If:
+            new = [walk(ob.cond, avail)]
+            new += [self.branch(kid, avail) for kid in kids[1:]]
+        elif t is And or t is Or:
+            values = list(ob.values)
+            if values:
+                values[0] = walk(values[0], avail)
+                rest = dict(avail)
+                values[1:] = [walk(v, rest) for v in values[1:]]
+                kill(avail, assigned(values[1:]))
+            new = [values]
+        elif t is Compare:
+            new = [walk(ob.expr, avail)]
+            ops = [(op, arg) for op, arg in ob.ops]
+            if ops:
+                ops[0] = ops[0][0], walk(ops[0][1], avail)
+                rest = dict(avail)
+                ops[1:] = [(op, walk(arg, rest)) for op, arg in ops[1:]]
+                kill(avail, assigned(ops[1:]))
+            new.append(ops)
+        elif t is For:
+            new = [walk(ob.iterable, avail)]
+            names = assigned(kids[1:])
+            kill(avail, names)      # they change on each pass
+            rest = dict(avail)
+            new += [walk(kid, rest) for kid in kids[1:]]
+        elif t in function_nodes:
+            new = list(kids)
+            new[5] = [walk(kid, avail) for kid in ob.defaults]
+        elif t is Save:
+            new = [walk(ob.value, avail), ob.name]
+            kill(avail, [ob.name])
+        elif t in sequential_nodes or t is tuple or t is list:
+            new = [walk(kid, avail) for kid in kids]
+        elif t is TryExcept:
+            # each handler starts from what the body is sure to have done
+            new = [self.branch(ob.body, avail)]
+            new.append(tuple([self.branch(h, avail) for h in ob.handlers]))
+            new.append(self.branch(ob.else_, avail))
+        elif t in branching_nodes:
+            new = [self.branch(kid, avail) for kid in kids]
+        else:
+            avail.clear()   # unknown node type: don't look inside
+            return ob
+        if self.temps:
+            return rebuild(ob, new)
+        return ob
+
+    def branch(self, ob, avail):
+        """Walk `ob`, which may not run, or may stop partway"""
+        new = self.walk(ob, dict(avail))
+        kill(avail, assigned(ob))
+        return new
+
+def kill(avail, names):
+    """Forget the values in `avail` that use any of the local `names`"""
+    if names is None:
+        avail.clear()
+    elif names:
+        for key, (occurrence, ob) in list(avail.items()):
+            if [n for n in local_names(ob) if n in names]:
+                del avail[key]
+
+def local_names(ob):
+    """Return a list of the names of the ``Local()`` nodes in `ob`"""
+    names = []
+    todo = [ob]
+    while todo:
+        ob = todo.pop()
+        if type(ob) is Local:
+            names.append(ob.name)
+        else:
+            todo.extend(scope_children(ob))
+    return names
+
+def assignments(ob):
+    """Return how many times `ob` may assign each local name, or ``None``
+
+    An assignment in a loop counts as two (i.e., more than once).  ``None`` is
+    returned if `ob` contains anything whose assignments are unknown, such as
+    labels, unknown node types, or functions that generate code.
+    """
+    counts = {}
+    todo = [(ob, 1)]
+    while todo:
+        ob, times = todo.pop()
+        t = type(ob)
+        if t is LocalAssign or t is Save:
+            counts[ob.name] = counts.get(ob.name, 0) + times
+            if t is Save:
+                todo.append((ob.value, times))
+        elif t in function_nodes:
+            todo.extend([(kid, times) for kid in ob.defaults])
+        elif t is For:
+            todo.extend([(ob.iterable, times), (ob.assign, 2), (ob.body, 2)])
+        elif t is Local or t is Const:
+            pass
+        elif t in sequential_nodes or t in branching_nodes or t is tuple or \
+            t is list or t is If or t is And or t is Or or t is Compare:
+            todo.extend([(kid, times) for kid in children(ob)])
+        elif isinstance(ob, Node) or opaque(ob) or callable(ob) and \
+            getattr(ob, '__name__', None) not in opcode:
+            return None
+    return counts
+
+def assigned(ob):
+    """Return the local names `ob` assigns, or ``None`` if they're unknown"""
+    names = {}
+    todo = [ob]
+    while todo:
+        ob = todo.pop()
+        t = type(ob)
+        if t is LocalAssign:
+            names[ob.name] = True
+        elif t is Save:
+            names[ob.name] = True
+            todo.append(ob.value)
+        elif t in function_nodes:
+            todo.extend(ob.defaults)
+        elif t is Local or t is Const:
+            pass
+        elif t in sequential_nodes or t in branching_nodes or t is tuple or \
+            t is list or t is If or t is And or t is Or or t is Compare or \
+            t is For:
+            todo.extend(children(ob))
+        elif isinstance(ob, Node) or opaque(ob):
+            return None
+    return names
+
+def opaque(ob):
+    """Is `ob` a label, jump, or block that CSE can't follow?"""
+    if isinstance(ob, Label) or isinstance(getattr(ob, '__self__', None), Label):
+        return True
+    return getattr(ob, '__name__', None) in opaque_ops
+
+class Pipeline(object):
+    """A set of rewrite passes, applied to a tree until none of them apply
+
+    Each pass is a function that takes a subtree and returns either the same
+    subtree, or a replacement for it.  Subtrees are rewritten children first,
+    and a replacement is itself rewritten until every pass leaves it alone,
+    so that the whole tree reaches a fixed point in a single walk.  Results
+    are memoized by subtree identity, so a subtree that's shared by several
+    parts of the tree is only rewritten once.
+    """
+
+    limit = 100     # maximum replacements of one subtree
+
+    def __init__(self, *passes):
+        self.passes = []
+        self.stats = {}     # pass name -> [calls, replacements, seconds]
+        for rewrite in passes:
+            self.register(rewrite)
+
+    def register(self, rewrite, *types, **kw):
+        """Add pass `rewrite`, applied only to subtrees of the given `types`
+
+        If no `types` are given, the pass sees every subtree.  The pass is
+        named by `name`, or by its ``__name__``.  Returns `rewrite`, so this
+        method can be used as a decorator on a function with no `types`.
+        """
+        name = kw.get('name') or getattr(rewrite, '__name__', repr(rewrite))
+        if name in self.stats:
+            raise ValueError("Duplicate pass name", name)
+        self.passes.append((name, rewrite, types and dict.fromkeys(types)))
+        self.stats[name] = [0, 0, 0.0]
+        return rewrite
+
+    def report(self):
+        """Return ``(name, calls, replacements, seconds)`` for each pass"""
+        return [
+            tuple([name] + self.stats[name]) for name, rewrite, t in self.passes
+        ]
+
+    def __call__(self, ob, memo=None):
+        """Return `ob`, rewritten by the passes until none of them apply
+
+        `memo` maps ``id(subtree)`` to ``(subtree, result)`` pairs; passing the
+        same dictionary to several calls shares the results between them.
+        """
+        if memo is None:
+            memo = {}
+        waiting = {}    # id(subtree) -> (replacement, number of replacements)
+        todo = [ob]
+        while todo:
+            node = todo[-1]
+            key = id(node)
+            if key in memo:
+                todo.pop()
+                continue
+            if key in waiting:
+                new, tries = waiting.pop(key)
+                result = memo[id(new)][1]
+                memo[key] = node, result
+                memo[id(result)] = result, result
+                todo.pop()
+                continue
+            kids = children(node)
+            missing = [kid for kid in kids if id(kid) not in memo]
+            if missing:
+                todo.extend(missing)
+                continue
+            new = [memo[id(kid)][1] for kid in kids]
+            for old, kid in zip(kids, new):
+                if old is not kid:
+                    new = rebuild(node, new)
+                    break
+            else:
+                new = node
+            replacement = self.rewrite(new)
+            if replacement is new:
+                memo[key] = node, new
+                memo[id(new)] = new, new
+                todo.pop()
+                continue
+            tries = 1
+            for other, count in waiting.values():
+                if other is node:
+                    tries = count+1     # node was itself a replacement
+            if id(replacement) in waiting or tries > self.limit:
+                raise AssertionError("Rewrite passes didn't converge", node)
+            waiting[key] = replacement, tries
+            todo.append(replacement)
+        return memo[id(ob)][1]
+
+    def rewrite(self, ob):
+        """Return the first replacement any pass makes for `ob`, or `ob`"""
+        t = type(ob)
+        stats = self.stats
+        for name, rewrite, types in self.passes:
+            if types and t not in types:
+                continue
+            started = timer()
+            new = rewrite(ob)
+            stat = stats[name]
+            stat[2] += timer() - started
+            stat[0] += 1
+            if new is not ob:
+                stat[1] += 1
+                return new
+        return ob
+
 
 nodetype()
 def YieldStmt(value=None, code=None):
@@ -371,24 +1236,94 @@ nodetype()
 def If(cond, then, else_=Pass, code=None):
     if code is None:
         return cond, then, else_
+    try:
+        if const_truth(cond):
+            return sequence(then)
+        return sequence(else_)
+    except NotAConstant:
+        pass
+    return gen_if(code, cond, then, else_)
+
+def gen_if(code, cond, then, else_):
     else_clause = Label()
     end_if = Label()
-    code(cond, else_clause.JUMP_IF_FALSE_OR_POP, then)
+    if 'POP_JUMP_IF_FALSE' not in opcode:
+        yield cond
+        else_clause.JUMP_IF_FALSE_OR_POP(code)
+        yield then
+        if code.stack_size is not None:
+            end_if.JUMP_FORWARD(code)
+        yield sequence(else_clause, Code.POP_TOP, else_, end_if)
+        return
+
+    yield gen_branch(code, cond, else_clause, False)
     if code.stack_size is not None:
-        end_if.JUMP_FORWARD(code)
-    code(else_clause, Code.POP_TOP, else_, end_if)
+        yield then
+        else_clause.touch(code)
+        if not else_clause.backpatches:
+            else_clause(code)   # else clause is unreachable
+            return
+        if code.stack_size is not None:
+            end_if.JUMP_FORWARD(code)
+    yield sequence(else_clause, else_, end_if)
 
 nodetype()
 def Function(body, name='<lambda>', args=(), var=None, kw=None, defaults=(), code=None):
     if code is None:
         return body, name, ntuple(args), var, kw, tuple(defaults)
     c = code.nested(name, args, var, kw)
+    c.scope_assignments = assignments(body)
     c(body)
     if c.stack_size is not None:
         code.return_()
+    return gen_function(code, c, body, name, args, var, kw, defaults)
+
+def gen_function(code, c, body, name, args, var, kw, defaults):
+    """Make a function, given nested code `c` with a ``Function()``'s body"""
+    bound = code.bind_frees and not var and bindable_frees(code, c) or []
+    if bound:
+        c._locals_to_args(bound)
     c = c.code(code)
     if defaults:
         code(*defaults)
+    for n in bound:
+        code.LOAD_FAST(n)
+    return make_function(code, c, len(defaults)+len(bound))
+
+def bindable_frees(code, c):
+    """Return the free variables of nested code `c` that `code` can bind
+
+    These are the fast locals of `code` that `c` reads, and that are either
+    arguments `code` never assigns, or are assigned exactly once in `code`'s
+    whole body (and not in a loop), on every path to the current position.
+    Since that needs the whole body, only the bodies of ``Function()`` nodes
+    (whose ``scope_assignments`` are counted in advance) can bind variables.
+    """
+    counts = code.scope_assignments
+    if counts is None or not code.co_flags & CO_OPTIMIZED:
+        return []
+    written = c.locals_written()
+    nargs = c.co_argcount + ((c.co_flags & CO_VARKEYWORDS)==CO_VARKEYWORDS)
+    frees = [n for n in c.co_varnames[nargs:] if n not in written]  # no *var
+    cells = dict.fromkeys(code.co_cellvars + code.co_freevars)
+    stores = {}
+    for ofs, op, arg in code:
+        if op==STORE_FAST or op==DELETE_FAST:
+            name = code.co_varnames[arg]
+            stores[name] = stores.get(name, 0) + 1 + (op==DELETE_FAST)
+    nargs = code.co_argcount \
+        + ((code.co_flags & CO_VARARGS)==CO_VARARGS) \
+        + ((code.co_flags & CO_VARKEYWORDS)==CO_VARKEYWORDS)
+    args = code.co_varnames[:nargs]
+    here = definitely_assigned(code.co_code, range(nargs)).get(code.here(), {})
+    assigned = [code.co_varnames[arg] for arg in here]
+    return [
+        n for n in frees if n in assigned and n not in cells and
+            stores.get(n, 0) == counts.get(n, 0) == (n not in args)
+    ]
+
+def make_function(code, c, ndefaults=0):
+    """Make a function from code object `c` and `ndefaults` stacked defaults"""
     if c.co_freevars:
         frees = c.co_freevars
         for name in frees:
@@ -396,15 +1331,299 @@ def Function(body, name='<lambda>', args=(), var=None, kw=None, defaults=(), cod
         if sys.version>='2.5':
             code.BUILD_TUPLE(len(frees))
         code.LOAD_CONST(c)
-        return code.MAKE_CLOSURE(len(defaults), len(frees))
+        return code.MAKE_CLOSURE(ndefaults, len(frees))
     else:
         code.LOAD_CONST(c)
-        return code.MAKE_FUNCTION(len(defaults))
+        return code.MAKE_FUNCTION(ndefaults)
 
 def ntuple(seq):
     if isinstance(seq, basestring): return seq
     return tuple(map(ntuple, seq))
 
+nodetype()
+def LazyFunction(body, name='<lambda>', args=(), var=None, kw=None, defaults=(), code=None):
+    if code is None:
+        return body, name, ntuple(args), var, kw, tuple(defaults)
+    lazy = LazyCode(code, body, name, args, var, kw)
+    return gen_lazy_function(code, lazy, defaults)
+
+def gen_lazy_function(code, lazy, defaults):
+    frees = lazy.frees
+    code.makecells(frees)
+    code.LOAD_CONST(lazy)
+    yield Call(Const(globals))
+    yield tuple(defaults)
+    if frees:
+        for name in frees:
+            code.LOAD_CLOSURE(name)
+        code.BUILD_TUPLE(len(frees))
+    else:
+        code.LOAD_CONST(())
+    code.CALL_FUNCTION(3)
+
+class LazyCode(object):
+    """Function factory that assembles a ``LazyFunction()``'s body on demand
+
+    Functions made by calling this object (with a globals dictionary, a tuple
+    of defaults, and a tuple of closure cells) start out with a small
+    "trampoline" code object.  The first call to any of them assembles the
+    real code object (just once, even if several threads make the first call
+    at the same time), swaps it into the function, and forwards the call.
+    """
+
+    def __init__(self, parent, body, name='<lambda>', args=(), var=None, kw=None):
+        self.name, self.args, self.var, self.kw = name, args, var, kw
+        self.body = body
+        self.frees = free_names(body, args, var, kw)
+        self.code = None
+        self.lock = threading.Lock()
+        self.proto = self.nested(parent)
+        self.stub = self.trampoline(parent)
+
+    def nested(self, parent):
+        """Return a child of `parent` with this function's signature and frees"""
+        c = parent.nested(self.name, self.args, self.var, self.kw)
+        c.makefree(self.frees + ['.self'])
+        return c
+
+    def trampoline(self, parent):
+        """Return the code object that functions start out with"""
+        stub = self.nested(parent)
+        self.forward(stub)
+        return stub.code()
+
+    def forward(self, code):
+        """Generate code to materialize the current function and call it"""
+        code.return_(
+            Call(
+                Call(Const(self.materialize), [Local('.self')]),
+                list(map(forward_arg, self.args)), (),
+                self.var and Local(self.var), self.kw and Local(self.kw), False
+            )
+        )
+
+    def assemble(self, c):
+        """Generate the body in nested code `c`, and return its code object"""
+        c(self.body)
+        if c.stack_size is not None:
+            c.return_()
+        return c.code()
+
+    def __call__(self, globals, defaults, closure):
+        holder = []
+        closure += getattr((lambda: holder), CLOSURE)
+        f = function(
+            self.code or self.stub, globals, self.name, defaults or None, closure
+        )
+        holder.append(f)
+        return f
+
+    def materialize(self, holder):
+        """Swap the real code into ``holder[0]``, assembling it if needed"""
+        code = self.code
+        if code is None:
+            self.lock.acquire()
+            try:
+                code = self.code
+                if code is None:
+                    code = self.code = self.assemble(self.proto)
+                    self.proto = self.body = None
+            finally:
+                self.lock.release()
+        f = holder[0]
+        setattr(f, CODE, code)
+        return f
+
+nodetype()
+def TieredFunction(body, name='<lambda>', args=(), var=None, kw=None, defaults=(), threshold=1000, code=None):
+    if code is None:
+        return body, name, ntuple(args), var, kw, tuple(defaults), threshold
+    lazy = TieredCode(code, body, name, args, var, kw, threshold)
+    return gen_lazy_function(code, lazy, defaults)
+
+class TieredCode(LazyCode):
+    """Function factory for ``TieredFunction()``
+
+    Functions start out with quickly-assembled "baseline" code (no compaction
+    or hoisting), that counts its calls.  Once the baseline code has been
+    called `threshold` times, the next call assembles the body again with the
+    enclosing code's options and compaction turned on, swaps the new code into
+    the function, and forwards the call.  (Generator bodies aren't tiered, and
+    are assembled on the first call, as for ``LazyFunction()``.)
+    """
+
+    def __init__(self, parent, body, name='<lambda>', args=(), var=None, kw=None,
+        threshold=1000
+    ):
+        self.threshold = threshold
+        LazyCode.__init__(self, parent, body, name, args, var, kw)
+        self.proto.compact = True
+
+    def trampoline(self, parent):
+        c = self.nested(parent)
+        c.compact = False
+        c.hoist = None
+        hot = Label()
+        c.LOAD_CONST(repeat(None, self.threshold))
+        hot.FOR_ITER(c)
+        c.POP_TOP()
+        c.POP_TOP()
+        c(self.body)
+        if c.co_flags & CO_GENERATOR:
+            # Calling the baseline code would just return a generator, so the
+            # call that should assemble and forward to the new code couldn't
+            return LazyCode.trampoline(self, parent)
+        if c.stack_size is not None:
+            c.return_()
+        hot(c)
+        self.forward(c)
+        return c.code()
+
+def forward_arg(arg):
+    if isinstance(arg, basestring):
+        return Local(arg)
+    return tuple(map(forward_arg, arg))
+
+def flat_names(args):
+    names = []
+    todo = [args]
+    while todo:
+        arg = todo.pop()
+        if isinstance(arg, basestring):
+            names.append(arg)
+        else:
+            todo.extend(arg)
+    return names
+
+def free_names(body, args=(), var=None, kw=None):
+    """Return the names `body` uses from an enclosing scope, without codegen
+
+    Like ``Code.code()``, this treats any ``Local()`` that isn't an argument or
+    the target of a ``LocalAssign()`` in the same scope as a free variable.
+    """
+    def bound(body, args, var, kw, outer={}):
+        names = dict.fromkeys(flat_names([args, var or (), kw or ()]))
+        todo = [body]
+        while todo:
+            ob = todo.pop()
+            if type(ob) is LocalAssign:
+                names[ob[1]] = 1
+            todo.extend(scope_children(ob))
+        names.update(outer)
+        return names
+
+    frees = []
+    todo = [(body, bound(body, args, var, kw))]
+    while todo:
+        ob, names = todo.pop()
+        t = type(ob)
+        if t is Local:
+            if ob[1] not in names and ob[1] not in frees:
+                frees.append(ob[1])
+        elif t in function_nodes:
+            todo.append((ob[6], names))     # defaults
+            todo.append((ob[1], bound(ob[1], ob[3], ob[4], ob[5], names)))
+        else:
+            todo.extend([(kid, names) for kid in children(ob)])
+    return frees
+
+function_nodes = dict.fromkeys([Function, LazyFunction, TieredFunction])
+
+sequential_nodes = dict.fromkeys([
+    Suite, Call, Getattr, Return, UnpackSequence, YieldStmt, LCAppend
+])
+branching_nodes = dict.fromkeys([TryExcept, TryFinally, ListComp])
+
+nodetype()
+def Specialize(name, types, body, code=None):
+    if code is None:
+        return name, tuple(types), body
+    return gen_specialize(code, name, types, body)
+
+def gen_specialize(code, name, types, body):
+    if not types or assigns(body, name):
+        yield body
+        return
+    end = Label()
+    yield Call(Const(type), [Local(name)])
+    for t in types:
+        other = Label()
+        code.DUP_TOP()
+        code.LOAD_CONST(t)
+        code.COMPARE_OP('is')
+        other.POP_JUMP_IF_FALSE(code)
+        code.POP_TOP()
+        yield substitute(body, TypeRewriter(name, t), scope_children)
+        if code.stack_size is not None:
+            end.JUMP_FORWARD(code)
+        other(code)
+    code.POP_TOP()
+    yield body
+    end(code)
+
+def assigns(ob, name):
+    """Does `ob` (or any function nested in it) contain ``LocalAssign(name)``?"""
+    todo = [ob]
+    while todo:
+        ob = todo.pop()
+        if type(ob) is LocalAssign and ob[1]==name:
+            return True
+        todo.extend(children(ob))
+    return False
+
+class TypeRewriter(object):
+    """Replacement mapping for ``substitute()``, when ``type(name) is type``
+
+    ``Call(Const(type), [Local(name)])`` becomes ``Const(type)``, and
+    ``Call(Const(isinstance), [Local(name), cls])`` becomes a ``Const`` too, if
+    `cls` is a constant.  Method calls on ``Local(name)`` become direct calls to
+    the method found on the type, if instances of the type can't override it.
+    """
+
+    def __init__(self, name, type):
+        self.local = Local(name)
+        self.type = type
+
+    def __getitem__(self, ob):
+        if type(ob) is Call:
+            func, args, kwargs, star, dstar, fold = ob[1:]
+            if not kwargs and not star and not dstar:
+                if func==Const(type) and args==(self.local,):
+                    return Const(self.type)
+                if func==Const(isinstance) and len(args)==2 and args[0]==self.local:
+                    try:
+                        return Const(issubclass(self.type, const_value(args[1])))
+                    except (NotAConstant, TypeError):
+                        pass
+            if type(func) is Getattr and func[1]==self.local:
+                method = self.method(func[2])
+                if method is not None:
+                    args, kwargs, star, dstar = substitute(
+                        ((self.local,)+args, kwargs, star, dstar), self,
+                        scope_children
+                    )
+                    return Call(Const(method), args, kwargs, star, dstar, fold)
+        raise KeyError(ob)
+
+    def method(self, name):
+        """The plain function or method descriptor for `name`, or ``None``"""
+        if getattr(self.type, '__dictoffset__', 1):
+            return None     # instances have a __dict__ that could override it
+        for cls in getattr(self.type, '__mro__', ()):
+            if '__getattribute__' in cls.__dict__:
+                if type(cls.__dict__['__getattribute__']) is function:
+                    return None
+                break
+        for cls in getattr(self.type, '__mro__', ()):
+            if name in cls.__dict__:
+                ob = cls.__dict__[name]
+                if hasattr(ob, '__set__') or not hasattr(ob, '__get__'):
+                    return None
+                if hasattr(ob, '__call__'):
+                    return ob
+                return None
+        return None
+
 
 
 
@@ -412,27 +1631,31 @@ nodetype()
 def Compare(expr, ops, code=None):
     if code is None:
         return fold_args(Compare, expr, tuple(ops))
+    return gen_compare(code, expr, ops)
+
+def gen_compare(code, expr, ops):
+    yield expr
     if len(ops)==1:
         op, arg = ops[0]
-        code(expr, arg)
-        return code.COMPARE_OP(op)
+        yield arg
+        code.COMPARE_OP(op)
+        return
     fail = Label()
     finish = Label()
-    code(expr)
     for op, arg in ops[:-1]:
-        code(arg)
+        yield arg
         code.DUP_TOP()
         code.ROT_THREE()
         code.COMPARE_OP(op)
         fail.JUMP_IF_FALSE_OR_POP(code)
     op, arg = ops[-1]
-    code(arg)
+    yield arg
     code.COMPARE_OP(op)
     finish.JUMP_FORWARD(code)
     fail(code)
     code.ROT_TWO()
     code.POP_TOP()
-    return finish(code)
+    finish(code)
 
 
 fast_to_deref = {
@@ -441,6 +1664,10 @@ fast_to_deref = {
 }
 
 deref_to_deref = dict([(k,k) for k in hasfree])
+fast_to_fast = dict([(k,k) for k in haslocal])
+deref_writes = dict.fromkeys([opcode[name] for name in
+    'STORE_DEREF DELETE_DEREF'.split() if name in opcode
+])
 
 
 
@@ -453,31 +1680,379 @@ nodetype()
 def And(values, code=None):
     if code is None:
         return fold_args(And, tuple(values))
+    return gen_and(code, values)
+
+def gen_and(code, values):
     end = Label()
     for value in values[:-1]:
         try:
             if const_value(value):
                 continue        # true constants can be skipped
         except NotAConstant:    # but non-constants require code
-            code(value, end.JUMP_IF_FALSE_OR_POP)
+            yield value
+            end.JUMP_IF_FALSE_OR_POP(code)
         else:       # and false constants end the chain right away
-            return code(value, end)
-    code(values[-1], end)
+            break
+    else:
+        value = values[-1]
+    yield value
+    end(code)
 
 nodetype()
 def Or(values, code=None):
     if code is None:
         return fold_args(Or, tuple(values))
+    return gen_or(code, values)
+
+def gen_or(code, values):
     end = Label()
     for value in values[:-1]:
         try:
             if not const_value(value):
                 continue        # false constants can be skipped
         except NotAConstant:    # but non-constants require code
-            code(value, end.JUMP_IF_TRUE_OR_POP)
+            yield value
+            end.JUMP_IF_TRUE_OR_POP(code)
         else:       # and true constants end the chain right away
-            return code(value, end)
-    code(values[-1], end)
+            break
+    else:
+        value = values[-1]
+    yield value
+    end(code)
+
+def gen_branch(code, cond, target, sense):
+    """Generator version of ``Code.branch()``"""
+    f = branch_types.get(type(cond))
+    if f is not None:
+        if code.record_origins:
+            code.set_origin(cond)
+        result = f(code, cond, target, sense)
+        if type(result) is GeneratorType:
+            yield result
+        return
+    try:
+        jump = (not const_truth(cond)) == (not sense)
+    except NotAConstant:
+        jump = None
+    if jump is None:
+        yield cond
+        pop_jump(code, target, sense)
+    elif jump:
+        jump_to(code, target)
+
+def branch_value(code, value, target, sense):
+    """Return a target that branches on `value`, folding constants"""
+    try:
+        truth = const_value(value)
+    except NotAConstant:
+        return gen_branch(code, value, target, sense)
+    if (not truth) == (not sense):
+        jump_to(code, target)
+    return Pass
+
+def jump_to(code, target):
+    """Unconditionally jump to Label `target`"""
+    target.touch(code)
+    if target.resolution is None:
+        return target.JUMP_FORWARD(code)
+    return target.JUMP_ABSOLUTE(code)
+
+def pop_jump(code, target, sense):
+    """Pop the top of stack, and jump to `target` if its truth is `sense`"""
+    if sense:
+        return target.POP_JUMP_IF_TRUE(code)
+    return target.POP_JUMP_IF_FALSE(code)
+
+def branch_and(code, node, target, sense):
+    values = profiled_values(code, node, False)
+    if sense:
+        skip = Label()
+        for value in values[:-1]:
+            yield branch_value(code, value, skip, False)
+            if code.stack_size is None:
+                break   # a false constant: the rest is unreachable
+        else:
+            yield branch_value(code, values[-1], target, True)
+        skip(code)
+    else:
+        for value in values:
+            yield branch_value(code, value, target, False)
+            if code.stack_size is None:
+                break
+
+def branch_or(code, node, target, sense):
+    values = profiled_values(code, node, True)
+    if not sense:
+        skip = Label()
+        for value in values[:-1]:
+            yield branch_value(code, value, skip, True)
+            if code.stack_size is None:
+                break   # a true constant: the rest is unreachable
+        else:
+            yield branch_value(code, values[-1], target, False)
+        skip(code)
+    else:
+        for value in values:
+            yield branch_value(code, value, target, True)
+            if code.stack_size is None:
+                break
+
+def branch_compare(code, node, target, sense):
+    expr, ops = node.expr, node.ops
+    yield expr
+    if len(ops)==1:
+        op, arg = ops[0]
+        yield arg
+        code.COMPARE_OP(op)
+        pop_jump(code, target, sense)
+        return
+    if code.co_flags & CO_OPTIMIZED:
+        # Keep each middle operand in a temporary local instead of on the
+        # stack, so that no path needs a cleanup block (or a jump around it)
+        skip = Label()
+        temp = None
+        for op, arg in ops[:-1]:
+            yield arg
+            if temp is None:    # (named after `arg`, which may use its own)
+                temp = '_[cmp%d]' % len(code.co_varnames)
+            code.STORE_FAST(temp)
+            code.LOAD_FAST(temp)
+            code.COMPARE_OP(op)
+            pop_jump(code, sense and skip or target, False)
+            code.LOAD_FAST(temp)
+        op, arg = ops[-1]
+        yield arg
+        code.COMPARE_OP(op)
+        pop_jump(code, target, sense)
+        if sense:
+            skip(code)
+        return
+    cleanup = Label()
+    done = Label()
+    for op, arg in ops[:-1]:
+        yield arg
+        code.DUP_TOP()
+        code.ROT_THREE()
+        code.COMPARE_OP(op)
+        pop_jump(code, cleanup, False)
+    op, arg = ops[-1]
+    yield arg
+    code.COMPARE_OP(op)
+    pop_jump(code, target, sense)
+    done.JUMP_FORWARD(code)
+    cleanup(code)
+    code.POP_TOP()      # remove the leftover operand
+    if not sense:
+        jump_to(code, target)
+    done(code)
+
+def profiled_values(code, node, decider):
+    """The values of an ``And`` or ``Or``, as affected by ``code.profile``
+
+    `decider` is the truth value that ends the chain (i.e. true for ``Or``).
+    """
+    values = node.values
+    profile = code.profile
+    if profile is None:
+        return values
+    elif not profile.recording:
+        return profile.operands(node, values, decider)
+    base = profile.site(node, 2*len(values))
+    profiled = []
+    for n, value in enumerate(values):
+        if not is_const(value):
+            value = Profiled(value, profile, base+2*n)
+        profiled.append(value)
+    return profiled
+
+nodetype()
+def Profiled(value, profile, index, code=None):
+    """Count evaluations of `value` at `index`, and true results at `index+1`"""
+    if code is None:
+        return value, profile, index
+    return gen_profiled(code, value, profile, index)
+
+def gen_profiled(code, value, profile, index):
+    profile.count(code, index)
+    yield value
+    false = Label()
+    code.DUP_TOP()
+    false.POP_JUMP_IF_FALSE(code)
+    profile.count(code, index+1)
+    false(code)
+
+def branch_profiled(code, node, target, sense):
+    yield node
+    pop_jump(code, target, sense)
+
+class Profile(object):
+    """Hit counts for ``And``/``Or`` conditions and ``TryExcept`` handlers
+
+    While `recording` is true, code generated with this profile as its
+    ``profile`` attribute counts how often each operand of an ``And`` or ``Or``
+    condition is evaluated and found true, and how often each exception
+    handler is used (and which exception types reach the handlers).  Once
+    `recording` is set to false, regenerating the same nodes with this profile
+    puts the operands or handlers that are most likely to decide the outcome
+    first, wherever that can't change what the code does.
+    """
+
+    recording = True
+
+    def __init__(self):
+        self.counts = array('l')
+        self.sites = {}
+        self.raised = {}    # index of a site's counters -> {exception type: 1}
+
+    def site(self, node, size):
+        """Return the index of `size` counters for `node`, allocating them"""
+        base = self.sites.get(node)
+        if base is None:
+            base = self.sites[node] = len(self.counts)
+            self.counts.extend([0]*size)
+        return base
+
+    def count(self, code, index):
+        """Generate code to add 1 to ``self.counts[index]``"""
+        counts = Const(self.counts)
+        code(
+            counts, index, Code.BINARY_SUBSCR, 1, Code.BINARY_ADD,
+            counts, index, Code.STORE_SUBSCR
+        )
+
+    def record_raised(self, code, index):
+        """Generate code to note the type of the exception being handled"""
+        raised = self.raised.setdefault(index, {})
+        code(
+            Code.DUP_TOP, Const(1), Code.ROT_TWO, Const(raised), Code.ROT_TWO,
+            Code.STORE_SUBSCR
+        )
+
+    def operands(self, node, values, decider):
+        """Return `values` with the likeliest to equal `decider` first"""
+        base = self.sites.get(node)
+        if base is None or not infallible(values):
+            return values
+        counts = self.counts
+        def key(n):
+            try:
+                truth = const_value(values[n])
+            except NotAConstant:
+                evals = counts[base+2*n]
+                if not evals:
+                    return 0
+                odds = counts[base+2*n+1] / float(evals)
+                if decider:
+                    return -odds
+                return odds-1
+            return -((not truth) == (not decider))
+        return [values[n] for n in sorted(range(len(values)), key=key)]
+
+    def handlers(self, node, handlers):
+        """Return `handlers` with the most-used first, if they don't overlap
+
+        Handlers overlap if one's exception types are subclasses of another's,
+        or if an exception type that reached them while recording would have
+        matched more than one of them.
+        """
+        base = self.sites.get(node)
+        if base is None:
+            return handlers
+        seen = []
+        groups = []
+        for typ, handler in handlers:
+            try:
+                classes = const_value(typ)
+            except NotAConstant:
+                return handlers
+            if type(classes) is not tuple:
+                classes = classes,
+            for cls in classes:
+                for other in seen:
+                    try:
+                        if issubclass(cls, other) or issubclass(other, cls):
+                            return handlers
+                    except TypeError:
+                        return handlers
+            seen.extend(classes)
+            groups.append(classes)
+        for exc in self.raised.get(base, ()):
+            try:
+                matches = [g for g in groups if issubclass(exc, g)]
+            except TypeError:
+                return handlers
+            if len(matches) > 1:
+                return handlers
+        counts = self.counts
+        return [
+            handlers[n] for n in sorted(
+                range(len(handlers)), key=lambda n: -counts[base+n]
+            )
+        ]
+
+def pure(ob):
+    """Can `ob` be evaluated in any order, or not at all, without side effects?
+
+    Constants, ``Local()`` nodes, ``is``/``is not`` comparisons, ``And`` and
+    ``Or`` nodes, and calls to `pure_functions` qualify, if all their operands
+    also qualify.
+    """
+    todo = [ob]
+    while todo:
+        ob = todo.pop()
+        t = type(ob)
+        if t is Local or is_const(ob):
+            continue
+        elif t is tuple or t is list or t is And or t is Or:
+            todo.extend(children(ob))
+        elif t is Compare:
+            for op, arg in ob.ops:
+                if op not in ('is', 'is not'):
+                    return False
+                todo.append(arg)
+            todo.append(ob.expr)
+        elif t is Call and type(ob.func) is Const:
+            if ob.func.value not in pure_functions or ob.kwargs:
+                return False
+            todo.extend([ob.args, ob.star, ob.dstar])
+        else:
+            return False
+    return True
+
+pure_functions = dict.fromkeys([type, isinstance, issubclass, callable, id])
+
+def infallible(ob):
+    """Can `ob` be evaluated in any order, or not at all, without errors?
+
+    Like ``pure()``, but calls don't qualify, since they can raise errors
+    (e.g. ``issubclass(None, int)``): only constants, ``Local()`` nodes,
+    ``is``/``is not`` comparisons, and ``And`` and ``Or`` nodes qualify, if
+    all their operands also qualify.
+    """
+    todo = [ob]
+    while todo:
+        ob = todo.pop()
+        t = type(ob)
+        if t is Local or is_const(ob):
+            continue
+        elif t is tuple or t is list or t is And or t is Or:
+            todo.extend(children(ob))
+        elif t is Compare:
+            for op, arg in ob.ops:
+                if op not in ('is', 'is not'):
+                    return False
+                todo.append(arg)
+            todo.append(ob.expr)
+        else:
+            return False
+    return True
+
+branch_types = {
+    And:        branch_and,
+    Or:         branch_or,
+    Compare:    branch_compare,
+    Profiled:   branch_profiled,
+}
 
 def with_name(f, name):
     try:
@@ -490,32 +2065,76 @@ def with_name(f, name):
         )
 
 
-EXTRA_JUMPS = 'JUMP_IF_FALSE_OR_POP JUMP_IF_TRUE_OR_POP JUMP_IF_FALSE JUMP_IF_TRUE'.split()
+EXTRA_JUMPS = '''JUMP_IF_FALSE_OR_POP JUMP_IF_TRUE_OR_POP JUMP_IF_FALSE JUMP_IF_TRUE
+    POP_JUMP_IF_FALSE POP_JUMP_IF_TRUE'''.split()
+
+statement_exits = dict.fromkeys([opcode[name] for name in
+    'RETURN_VALUE YIELD_VALUE BREAK_LOOP CONTINUE_LOOP'.split() if name in opcode
+])
+
+unsplittable_ops = dict.fromkeys(
+    [opname[op] for op in hasjrel+hasjabs] + EXTRA_JUMPS + '''RETURN_VALUE
+    YIELD_VALUE BREAK_LOOP CONTINUE_LOOP SETUP_LOOP SETUP_EXCEPT SETUP_FINALLY
+    SETUP_WITH POP_BLOCK END_FINALLY'''.split()
+)
+
+opaque_ops = dict.fromkeys(
+    [opname[op] for op in hasjrel+hasjabs] + EXTRA_JUMPS + '''BREAK_LOOP
+    CONTINUE_LOOP SETUP_LOOP SETUP_EXCEPT SETUP_FINALLY SETUP_WITH POP_BLOCK
+    END_FINALLY'''.split()
+)
 
 class Label(object):
     """A forward-referenceable location in a ``Code`` object"""
 
-    __slots__ = 'backpatches', 'resolution'
+    __slots__ = 'backpatches', 'resolution', 'code'
 
     def __init__(self):
         self.backpatches = []
         self.resolution = None
+        self.code = None    # the code whose view of the label is loaded
+
+    def state(self):
+        return self.resolution, self.backpatches[:]
+
+    def restore(self, state):
+        self.resolution, self.backpatches[:] = state
+
+    def touch(self, code):
+        """Load `code`'s view of this label, and journal it for ``rollback()``
+
+        Each code object (e.g. each fork of a code) has its own view of a
+        label's resolution and backpatches, which are parked in the code's
+        ``labels`` while another code is using the label.
+        """
+        if self.code is not code:
+            if self.code is not None:
+                self.code.labels[self] = self.state()
+            self.restore(code.labels.get(self) or (None, []))
+            code.labels[self] = None
+            self.code = code
+        code._journal(self)
 
     def SETUP_EXCEPT(self, code):
+        self.touch(code)
         code.SETUP_EXCEPT(); self.backpatches.append(code.blocks[-1][-1])
 
     def SETUP_FINALLY(self, code):
+        self.touch(code)
         code.SETUP_FINALLY(); self.backpatches.append(code.blocks[-1][-1])
 
     def SETUP_LOOP(self, code):
+        self.touch(code)
         code.SETUP_LOOP(); self.backpatches.append(code.blocks[-1][-1])
 
     def POP_BLOCK(self, code):
+        self.touch(code)
         self.backpatches[0] = code.POP_BLOCK()
 
     for name in [opname[op] for op in hasjrel+hasjabs]+EXTRA_JUMPS:
         if name not in locals():
             def do_jump(self, code, name=name):
+                self.touch(code)
                 method = getattr(code, name)
                 if self.resolution is None:
                     return self.backpatches.append(method())
@@ -525,11 +2144,12 @@ class Label(object):
     del do_jump
 
     def __call__(self, code):
+        self.touch(code)
         if self.resolution is not None:
             raise AssertionError("Label previously defined")
         self.resolution = resolution = len(code.co_code)
         for p in self.backpatches:
-            if p: p()
+            if p: p(code)
 
 class Code(object):
     co_argcount = 0
@@ -540,19 +2160,36 @@ class Code(object):
     co_firstlineno = 0
     co_freevars = ()
     co_cellvars = ()
-    _last_lineofs = 0
     _ss = 0
     _tmp_level = 0
+    compact = False
+    interner = None
+    hoist = None
+    split_budget = None
+    split_sizes = None  # id(statement) -> (statement, size, checked)
+    profile = None
+    record_origins = False
+    inline_budget = None
+    bind_frees = False
+    scope_assignments = None    # see ``bindable_frees()``
+    cse = None
+    _cse_level = 0
+    undo = None     # changes made in place since the first ``mark()``
 
     def __init__(self):
         self.co_code = array('B')
         self.co_consts = [None]
         self.co_names = []
         self.co_varnames = []
-        self.co_lnotab = array('B')
+        self.lines = []
+        self.spans = []
+        self.origins = []
+        self.splits = []
+        self.split_writes = []  # names assigned by ``splits`` helpers
         self.emit = self.co_code.append
         self.blocks = []
         self.stack_history = []
+        self.labels = {}    # Label -> this code's view of it, when parked
 
     def emit_arg(self, op, arg):
         emit = self.emit
@@ -566,42 +2203,41 @@ class Code(object):
 
     def locals_written(self):
         vn = self.co_varnames
+        cells = self.co_cellvars + self.co_freevars
         hl = dict.fromkeys([STORE_FAST, DELETE_FAST])
-        return dict.fromkeys([vn[arg] for ofs, op, arg in self if op in hl])
+        return dict.fromkeys(
+            [vn[arg] for ofs, op, arg in self if op in hl] +
+            [cells[arg] for ofs, op, arg in self if op in deref_writes] +
+            self.split_writes
+        )
 
 
 
 
-    def set_lineno(self, lno):
+    def set_lineno(self, lno, span=None):
+        here = len(self.co_code)
+        if span is not None:
+            self._add_event(self.spans, here, span)
         if not self.co_firstlineno:
-            self.co_firstlineno = self._last_line = lno
-            return
-
-        append = self.co_lnotab.append
-        incr_line = lno - self._last_line
-        incr_addr = len(self.co_code) - self._last_lineofs
-        if not incr_line:
-            return
-
-        assert incr_addr>=0 and incr_line>=0
-
-        while incr_addr>255:
-            append(255)
-            append(0)
-            incr_addr -= 255
+            self.co_firstlineno = lno
+        else:
+            self._add_event(self.lines, here, lno)
 
-        while incr_line>255:
-            append(incr_addr)
-            append(255)
-            incr_line -= 255
-            incr_addr = 0
+    def _add_event(self, events, here, value):
+        if events:
+            ofs, last = events[-1]
+            if last==value:
+                return
+            elif ofs==here:
+                self._journal(events, len(events)-1, len(events))
+                events[-1] = here, value
+                return
+        events.append((here, value))
 
-        if incr_addr or incr_line:
-            append(incr_addr)
-            append(incr_line)
+    def get_lnotab(self):
+        return make_lnotab(self.lines, self.co_firstlineno)
 
-        self._last_line = lno
-        self._last_lineofs = len(self.co_code)
+    co_lnotab = property(get_lnotab)
 
     def YIELD_VALUE(self):
         self.stackchange(stack_effects[YIELD_VALUE])
@@ -615,25 +2251,19 @@ class Code(object):
 
     def LOAD_CONST(self, const):
         self.stackchange((0,1))
-        pos = 0
         hashable = True
         try:
             hash(const)
         except TypeError:
             hashable = False
-        while 1:
-            try:
-                arg = self.co_consts.index(const, pos)
-                it = self.co_consts[arg]
-            except ValueError:
-                arg = len(self.co_consts)
-                self.co_consts.append(const)
+        # (not list.index(), whose error message is the repr of `const`, and
+        # so can't be built for a very deeply nested tuple)
+        for arg, it in enumerate(self.co_consts):
+            if it is const or type(it) is type(const) and hashable and it==const:
                 break
-            else:
-                if type(it) is type(const) and (hashable or it is const):
-                    break
-            pos = arg+1
-            continue
+        else:
+            arg = len(self.co_consts)
+            self.co_consts.append(const)
         return self.emit_arg(LOAD_CONST, arg)
 
     def CALL_FUNCTION(self, argc=0, kwargc=0, op=CALL_FUNCTION, extra=0):
@@ -658,6 +2288,11 @@ class Code(object):
         self.stackchange((count,1))
         self.emit_arg(BUILD_LIST,count)
 
+    if 'BUILD_LIST_UNPACK' in opcode:
+        def BUILD_LIST_UNPACK(self, count):
+            self.stackchange((count,1))
+            self.emit_arg(BUILD_LIST_UNPACK,count)
+
     def UNPACK_SEQUENCE(self, count):
         self.stackchange((1,count))
         self.emit_arg(UNPACK_SEQUENCE,count)
@@ -694,6 +2329,108 @@ class Code(object):
     def here(self):
         return len(self.co_code)
 
+    def mark(self):
+        """Return a snapshot of the code's state, for use with ``rollback()``
+
+        The snapshot covers the bytecode, constants, names, line numbers, stack
+        tracking and open blocks, along with this code's view of any ``Label``
+        it uses.  Only the lengths of lists are saved: once a code has been
+        marked, it journals any list items (and label states) it changes in
+        place, so that ``rollback()`` can undo the changes.
+        """
+        if self.undo is None:
+            self.undo = []
+        lists = {}
+        state = {}
+        for k, v in self.__dict__.items():
+            if k in ('emit', 'undo', 'labels'):
+                continue
+            elif k=='blocks':
+                state[k] = v[:]
+            elif type(v) in (list, array):
+                lists[k] = v, len(v)
+            else:
+                state[k] = v
+        return self, len(self.undo), lists, state
+
+    def rollback(self, mark):
+        """Restore the state saved by ``mark()`` (or by a fork's ``mark()``)
+
+        Marks can be restored in any order, and as many times as you like.
+        Restoring one of this code's own marks takes time proportional to the
+        changes made since, while restoring another code's mark copies it.
+        """
+        code, pos, lists, state = mark
+        if self.undo is None:
+            self.undo = []
+        self.__dict__.setdefault('labels', {})
+        if code is self:
+            for target, start, stop, old in self.undo[pos:][::-1]:
+                self._restore(target, start, stop, old)
+        else:
+            lists, labels = code._snapshot(mark)
+            for lbl in list(self.labels) + list(labels):
+                self._restore(lbl, None, None, labels.get(lbl) or (None, []))
+        for k in list(self.__dict__):
+            if k not in state and k not in lists and \
+                k not in ('undo', 'labels'):
+                del self.__dict__[k]
+        for k, v in state.items():
+            if k=='blocks':
+                v = v[:]
+            self.__dict__[k] = v
+        for k, (ob, size) in lists.items():
+            self.__dict__[k] = ob
+            if len(ob) > size:
+                self._journal(ob, size)
+                del ob[size:]
+        self.emit = self.co_code.append
+
+    def _snapshot(self, mark):
+        """Return copies of the lists and label views saved by `mark`"""
+        code, pos, lists, state = mark
+        copies = dict([(id(ob), ob[:]) for ob, size in lists.values()])
+        labels = dict([(lbl, self.label_state(lbl)) for lbl in self.labels])
+        for target, start, stop, old in self.undo[pos:][::-1]:
+            if start is None:
+                labels[target] = old
+            elif id(target) in copies:
+                copies[id(target)][start:stop] = old
+        return dict([
+            (k, (copies[id(ob)][:size], size)) for k, (ob, size) in lists.items()
+        ]), labels
+
+    def label_state(self, lbl):
+        """Return this code's view of `lbl`, as a ``(resolution, patches)``"""
+        if lbl.code is self:
+            return lbl.state()
+        return self.labels.get(lbl) or (None, [])
+
+    def _journal(self, target, start=None, stop=None):
+        """Save ``target[start:stop]``, or label `target`'s state, if marked"""
+        undo = self.undo
+        if undo is not None:
+            if start is None:
+                undo.append((target, None, None, self.label_state(target)))
+            else:
+                undo.append((target, start, stop, target[start:stop]))
+
+    def _restore(self, target, start, stop, old):
+        """Undo a journaled change, journaling the undo in turn"""
+        self._journal(target, start, stop)
+        if start is not None:
+            target[start:stop] = old
+        elif target.code is self:
+            target.restore(old)
+        else:
+            self.labels[target] = old
+
+    def fork(self):
+        """Return an independent copy of this code, for speculative use"""
+        code = self.__class__.__new__(self.__class__)
+        code.rollback(self.mark())
+        return code
+
 
     if 'UNARY_CONVERT' not in opcode:
         def UNARY_CONVERT(self):
@@ -765,6 +2502,7 @@ class Code(object):
         else:
             actual = self.stack_history[location]
             if actual is None:
+                self._journal(self.stack_history, location, location+1)
                 self.stack_history[location] = actual = expected
 
         if actual != expected:
@@ -788,12 +2526,12 @@ class Code(object):
                     target = offset - (posn+6)
             return target
 
-        def backpatch(offset):
+        def backpatch(code, offset):
             target = jump_target(offset)
             if target>0xFFFF:
                 raise AssertionError("Forward jump span must be <64K bytes")
-            self.patch_arg(posn, 0, target)
-            self.branch_stack(offset, old_level)
+            code.patch_arg(posn, 0, target)
+            code.branch_stack(offset, old_level)
 
         if op==FOR_ITER:
             old_level = self.stack_size = self.stack_size - 1
@@ -809,7 +2547,8 @@ class Code(object):
         else:
             self.emit_arg(op, 0)
             def lbl(code=None):
-                backpatch(self.here())
+                code = code or self     # a fork may resolve the jump
+                backpatch(code, code.here())
         if op in (JUMP_FORWARD, JUMP_ABSOLUTE, CONTINUE_LOOP):
             self.stack_unknown()
         return lbl
@@ -887,6 +2626,24 @@ class Code(object):
     else:
         globals()['POP_JUMP_IF_FALSE'] = -1
 
+    if 'POP_JUMP_IF_TRUE' not in opcode:
+        def POP_JUMP_IF_TRUE(self, address=None):
+            skip = self.JUMP_IF_FALSE()
+            self.POP_TOP()
+            lbl = self.JUMP_ABSOLUTE(address)
+            skip()
+            self.POP_TOP()
+            return lbl
+
+    if 'POP_JUMP_IF_FALSE' not in opcode:
+        def POP_JUMP_IF_FALSE(self, address=None):
+            skip = self.JUMP_IF_TRUE()
+            self.POP_TOP()
+            lbl = self.JUMP_ABSOLUTE(address)
+            skip()
+            self.POP_TOP()
+            return lbl
+
     if 'LIST_APPEND' in opcode and LIST_APPEND>=HAVE_ARGUMENT:
         def LIST_APPEND(self, depth):
             self.stackchange((depth+1, depth))
@@ -919,22 +2676,87 @@ class Code(object):
         return self.jump(op, label)
 
     def __call__(self, *args):
+        """Generate code for each of `args`, in order
+
+        Nodes (and other code generation targets) may return a generator
+        instead of generating their children directly.  Each value it yields
+        is generated in turn, before the generator is resumed.  This is done
+        with an explicit stack of generators, rather than by recursion, so
+        that arbitrarily deep trees can be generated.
+
+        If ``record_origins`` is true, the innermost node being generated is
+        recorded in ``origins`` whenever it changes.  A generator that isn't a
+        node's own belongs to the node current when it's yielded, which lets
+        functions like ``gen_branch()`` claim their code for a node by calling
+        ``set_origin()`` first.
+        """
         last = None
-        for ob in args:
-            if hasattr(ob, '__call__'):
-                last = ob(self)
-            else:
-                try:
-                    f = generate_types[type(ob)]
-                except KeyError:
-                    raise TypeError("Can't generate", ob)
+        todo = [iter(args)]
+        track = self.record_origins
+        if track:
+            owners = [self.origins and self.origins[-1][1] or None]
+            base = owners[0]
+        while todo:
+            for ob in todo[-1]:
+                if isinstance(ob, Node):
+                    if track:
+                        self.set_origin(ob)
+                    last = ob.__emit__(self)
+                    if track and type(last) is not GeneratorType:
+                        self.set_origin(owners[-1])
+                elif type(ob) is GeneratorType:
+                    last = ob
+                elif hasattr(ob, '__call__'):
+                    last = ob(self)
                 else:
-                    last = f(self, ob)
+                    try:
+                        f = generate_types[type(ob)]
+                    except KeyError:
+                        raise TypeError("Can't generate", ob)
+                    else:
+                        last = f(self, ob)
+                if type(last) is GeneratorType:
+                    todo.append(last)
+                    if track:
+                        owners.append(isinstance(ob, Node) and ob or
+                            self.origins and self.origins[-1][1] or owners[-1])
+                    last = None
+                    break
+            else:
+                todo.pop()
+                if track:
+                    owners.pop()
+                    self.set_origin(owners and owners[-1] or base)
+                if todo:
+                    last = None
         return last
 
+    def set_origin(self, node):
+        """Record that code generated from here on comes from `node`"""
+        origins = self.origins
+        offset = len(self.co_code)
+        if origins:
+            if origins[-1][1] is node:
+                return
+            if origins[-1][0]==offset:
+                self._journal(origins, len(origins)-1)
+                origins.pop()   # nothing was generated for the previous node
+                if origins and origins[-1][1] is node:
+                    return
+        origins.append((offset, node))
+
     def return_(self, ob=None):
         return self(ob, Code.RETURN_VALUE)
 
+    def branch(self, cond, target, sense=False):
+        """Jump to Label `target` if `cond`'s truth value is `sense`
+
+        The value of `cond` is not left on the stack, whether the jump is
+        taken or not.  Node types registered in ``branch_types`` can do this
+        without computing a value at all.
+        """
+        return self(gen_branch(self, cond, target, sense))
+
     decorate(classmethod)
     def from_function(cls, function, copy_lineno=False):
         code = cls.from_code(getattr(function, CODE), copy_lineno)
@@ -983,21 +2805,26 @@ class Code(object):
 
 
     def patch_arg(self, offset, oldarg, newarg):
-        code = self.co_code
-        if (oldarg>0xFFFF) != (newarg>0xFFFF):
+        if newarg>0xFFFF and oldarg<=0xFFFF:
             raise AssertionError("Can't change argument size", oldarg, newarg)
-        code[offset+1] = newarg & 255
-        code[offset+2] = (newarg>>8) & 255
-        if newarg>0xFFFF:
-            newarg >>=16
-            code[offset-2] = newarg & 255
-            code[offset-1] = (newarg>>8) & 255
+        self._journal(self.co_code, offset-3*(oldarg>0xFFFF), offset+3)
+        set_arg(self.co_code, offset, oldarg>0xFFFF, newarg)
 
     def nested(self, name='<lambda>', args=(), var=None, kw=None, cls=None):
         if cls is None:
             cls = self.__class__
         code = cls.from_spec(name, args, var, kw)
         code.co_filename=self.co_filename
+        code.compact = self.compact
+        code.interner = self.interner
+        code.hoist = self.hoist
+        code.split_budget = self.split_budget
+        code.split_sizes = self.split_sizes
+        code.profile = self.profile
+        code.record_origins = self.record_origins
+        code.inline_budget = self.inline_budget
+        code.bind_frees = self.bind_frees
+        code.cse = self.cse
         return code
 
     def __iter__(self):
@@ -1046,6 +2873,31 @@ class Code(object):
                 )
             self._locals_to_cells()
 
+    def _cells_to_frees(self, names):
+        if names:
+            old = self.co_cellvars + self.co_freevars
+            self.co_cellvars = tuple(
+                [n for n in self.co_cellvars if n not in names]
+            )
+            self.co_freevars += tuple(names)
+            new = list(self.co_cellvars + self.co_freevars)
+            self._patch(
+                deref_to_deref,
+                dict([(p, new.index(n)) for p, n in enumerate(old)])
+            )
+
+    def _locals_to_args(self, names):
+        old = self.co_varnames
+        argcount = self.co_argcount
+        self.co_varnames = old[:argcount] + list(names) + [
+            n for n in old[argcount:] if n not in names
+        ]
+        self.co_argcount += len(names)
+        self._patch(
+            fast_to_fast,
+            dict([(p, self.co_varnames.index(n)) for p, n in enumerate(old)])
+        )
+
     def _locals_to_cells(self):
         freemap = dict(
             [(n,p) for p,n in enumerate(self.co_cellvars+self.co_freevars)]
@@ -1072,6 +2924,7 @@ class Code(object):
                     self.patch_arg(ofs, arg, argmap[arg])
                 elif arg is not None:
                     continue
+                self._journal(code, ofs, ofs+1)
                 code[ofs] = opmap[op]
 
     def code(self, parent=None):
@@ -1081,6 +2934,14 @@ class Code(object):
         flags = self.co_flags & ~CO_NOFREE
         if parent is not None:
             locals_written = self.locals_written()
+            # cells we never assign belong to an enclosing scope
+            self._cells_to_frees([
+                n for n in self.co_cellvars if n not in locals_written
+                and n not in self.co_varnames[:self.co_argcount
+                    + ((self.co_flags & CO_VARARGS)==CO_VARARGS)
+                    + ((self.co_flags & CO_VARKEYWORDS)==CO_VARKEYWORDS)
+                ]
+            ])
             self.makefree([
                 n for n in self.co_varnames[
                     self.co_argcount
@@ -1095,13 +2956,102 @@ class Code(object):
         elif parent is not None and self.co_freevars:
             parent.makecells(self.co_freevars)
 
-        return NEW_CODE(
-            self.co_argcount, len(self.co_varnames),
-            self.co_stacksize, flags, to_code(self.co_code),
-            tuple(self.co_consts), tuple(self.co_names),
-            tuple(self.co_varnames),
+        if self.compact:
+            (bytecode, consts, names, varnames, lines, spans, origins
+            ) = self.compacted()
+        else:
+            bytecode, consts, names, varnames, lines, spans, origins = (
+                self.co_code, self.co_consts, self.co_names, self.co_varnames,
+                self.lines, self.spans, self.origins
+            )
+        interner = self.interner
+        if interner is not None:
+            consts = list(map(interner.const, consts))
+        code = NEW_CODE(
+            self.co_argcount, len(varnames),
+            self.co_stacksize, flags, to_code(bytecode),
+            tuple(consts), tuple(names), tuple(varnames),
             self.co_filename, self.co_name, self.co_firstlineno,
-            to_code(self.co_lnotab), self.co_freevars, self.co_cellvars
+            to_code(make_lnotab(lines, self.co_firstlineno)),
+            self.co_freevars, self.co_cellvars
+        )
+        built = code
+        if interner is not None:
+            code = interner.code(code)
+        # a shared code object keeps the spans and origins it was first given
+        if spans and (code is built or not has_offsets(source_spans, code)):
+            register_spans(code, spans)
+        if origins and (code is built or not has_offsets(node_origins, code)):
+            register_origins(code, origins)
+        return code
+
+    def compacted(self):
+        """Return compacted (co_code, consts, names, varnames, lines, spans,
+        origins)
+
+        Stores to fast locals that are never read are dropped (along with a
+        preceding side-effect-free push, if there is one), and constants,
+        names, and local variables that are no longer referenced are removed
+        and the remaining operands renumbered.  The ``Code`` object itself is
+        left untouched, so code generation can continue afterwards.
+        """
+        flags = self.co_flags
+        nargs = (self.co_argcount + ((flags & CO_VARARGS)==CO_VARARGS)
+                 + ((flags & CO_VARKEYWORDS)==CO_VARKEYWORDS))
+        instructions = list(iter_code(self.co_code))
+        edits = {}
+        if flags & CO_OPTIMIZED:
+            read = {}
+            targets = {}
+            for start, op, arg, jump, end in instructions:
+                if op in haslocal and op != STORE_FAST:
+                    read[arg] = 1
+                if jump is not None:
+                    targets[jump] = 1
+            prev = None
+            for start, op, arg, jump, end in instructions:
+                if op==STORE_FAST and arg>=nargs and arg not in read:
+                    if (start not in targets and prev is not None
+                        and prev[1] in (LOAD_CONST, DUP_TOP)
+                        and prev[0] not in edits):
+                        edits[prev[0]] = edits[start] = ()
+                    else:
+                        edits[start] = (POP_TOP,)
+                prev = start, op
+        bytecode, where = relocate(self.co_code, edits)
+
+        consts = {}
+        if self.co_consts:
+            consts[0] = 0   # co_consts[0] is the docstring slot; always keep
+        names = {}
+        varnames = dict([(n, n) for n in range(nargs)])
+        used = [
+            (start, op, arg, end) for start, op, arg, jump, end
+            in iter_code(bytecode)
+        ]
+        for start, op, arg, end in used:
+            for table, ops in (consts,hasconst), (names,hasname), \
+                              (varnames,haslocal):
+                if op in ops and arg not in table:
+                    table[arg] = len(table)
+        for start, op, arg, end in used:
+            for table, ops in (consts,hasconst), (names,hasname), \
+                              (varnames,haslocal):
+                if op in ops and table[arg] != arg:
+                    set_arg(bytecode, end-3, end-start>3, table[arg])
+
+        def renumber(seq, table):
+            items = [(new, seq[old]) for old, new in table.items()]
+            items.sort()
+            return [item for new, item in items]
+
+        return (
+            bytecode, renumber(self.co_consts, consts),
+            renumber(self.co_names, names),
+            renumber(self.co_varnames, varnames),
+            [(where[ofs], line) for ofs, line in self.lines],
+            [(where[ofs], span) for ofs, span in self.spans],
+            [(where[ofs], node) for ofs, node in self.origins],
         )
 
 
@@ -1170,6 +3120,76 @@ for op in hasjrel+hasjabs:
         setattr(Code, opname[op], with_name(do_jump, opname[op]))
 
 
+class UncheckedCode(Code):
+    """A ``Code`` that trusts its targets to generate valid code
+
+    The stack level is still tracked (and its maximum recorded), but stack
+    underflows and mismatched levels at jump targets aren't detected, and no
+    history of stack levels is kept.  Use ``verify()`` to check the results.
+    """
+
+    def stackchange(self, inout):
+        ss = self._ss - inout[0] + inout[1]
+        self._ss = ss
+        if ss > self.co_stacksize:
+            self.co_stacksize = ss
+
+    def set_stack_size(self, size):
+        self._ss = size
+        if size is not None and size > self.co_stacksize:
+            self.co_stacksize = size
+
+    stack_size = property(Code.get_stack_size, set_stack_size)
+
+    def branch_stack(self, location, expected):
+        if self._ss is None:
+            self._ss = expected
+
+
+class StatementSizer(UncheckedCode):
+    """An ``UncheckedCode`` that measures the statements of its suites
+
+    Each statement of a ``Suite()`` is recorded with its size, or with None
+    if it takes values from the stack, leaves any behind, or opens or closes
+    blocks.  Code nested in it measures its statements too.  ``finish()``
+    then adds the sizes to ``split_sizes``, ruling out statements that
+    return, yield, break, or continue.
+    """
+
+    low = 0     # lowest stack level reached by the current statement
+
+    def __init__(self):
+        UncheckedCode.__init__(self)
+        self.sized = []     # (statement, code, start, end) recorded so far
+
+    def stackchange(self, inout):
+        if self._ss is None:
+            raise AssertionError("Unknown stack size at this location")
+        if self._ss - inout[0] < self.low:
+            self.low = self._ss - inout[0]
+        UncheckedCode.stackchange(self, inout)
+
+    def nested(self, *args, **kw):
+        code = UncheckedCode.nested(self, *args, **kw)
+        code.sized = self.sized
+        return code
+
+    def finish(self):
+        exits = {}  # code -> offsets of its statement exits
+        for ob, code, start, end in self.sized:
+            if start is not None:
+                if code not in exits:
+                    exits[code] = [ofs for ofs, op, arg in code
+                        if op in statement_exits]
+                i = bisect_left(exits[code], start)
+                if i < len(exits[code]) and exits[code][i] < end:
+                    start = None
+            if start is None:
+                self.split_sizes[id(ob)] = ob, None, False
+            else:
+                self.split_sizes[id(ob)] = ob, end-start, False
+
+
 
 
 
@@ -1188,20 +3208,66 @@ for op in hasjrel+hasjabs:
 
 
 def gen_map(code, ob):
+    if ob:
+        try:
+            items = dict(
+                [(const_value(k), const_value(v)) for k,v in ob.items()]
+            )
+        except (NotAConstant, TypeError):
+            pass    # (a key that's unhashable fails when the code is run)
+        else:
+            # Copy a constant dictionary, instead of building it item by item
+            code.LOAD_CONST(items)
+            code.LOAD_ATTR('copy')
+            return code.CALL_FUNCTION()
+    return gen_map_items(code, ob)
+
+def gen_map_items(code, ob):
+    if 'STORE_MAP' in opcode:
+        code.BUILD_MAP(len(ob))
+        for k,v in ob.items():
+            yield v
+            yield k
+            code.STORE_MAP()
+        return
     code.BUILD_MAP(0)
     for k,v in ob.items():
         code.DUP_TOP()
-        code(k, v)
+        yield k
+        yield v
         code.ROT_THREE()
         code.STORE_SUBSCR()
 
+def gen_items(items, build):
+    for ob in items:
+        yield ob
+    build(len(items))
+
 def gen_tuple(code, ob):
-    code(*ob)
-    return code.BUILD_TUPLE(len(ob))
+    try:
+        return code.LOAD_CONST(const_value(ob))
+    except NotAConstant:
+        pass
+    return gen_items(ob, code.BUILD_TUPLE)
 
 def gen_list(code, ob):
-    code(*ob)
-    return code.BUILD_LIST(len(ob))
+    if len(ob)>1:
+        try:
+            items = const_value(tuple(ob))
+        except NotAConstant:
+            pass
+        else:
+            if 'BUILD_LIST_UNPACK' in opcode:
+                code.LOAD_CONST(items)
+                return code.BUILD_LIST_UNPACK(1)
+            elif 'STORE_SLICE+0' in opcode and len(ob)>4:
+                # new_list[:] = items
+                code.LOAD_CONST(items)
+                code.BUILD_LIST(0)
+                code.DUP_TOP()
+                code.ROT_THREE()
+                return code.STORE_SLICE_0()
+    return gen_items(ob, code.BUILD_LIST)
 
 generate_types = {
     int:        Code.LOAD_CONST,
@@ -1228,6 +3294,24 @@ generate_types = {
 
 
 
+uninlinable_ops = dict.fromkeys([opcode[name] for name in '''SETUP_LOOP
+    SETUP_EXCEPT SETUP_FINALLY SETUP_WITH SETUP_ASYNC_WITH POP_BLOCK
+    END_FINALLY WITH_CLEANUP WITH_CLEANUP_START YIELD_VALUE YIELD_FROM
+    BREAK_LOOP CONTINUE_LOOP LOAD_LOCALS LOAD_NAME STORE_NAME DELETE_NAME
+    IMPORT_STAR EXEC_STMT LOAD_CLOSURE MAKE_CLOSURE LOAD_DEREF STORE_DEREF
+    DELETE_DEREF LOAD_CLASSDEREF'''.split() if name in opcode
+])
+
+global_ops = dict.fromkeys([opcode[name] for name in '''LOAD_GLOBAL
+    STORE_GLOBAL DELETE_GLOBAL IMPORT_NAME MAKE_FUNCTION'''.split()
+    if name in opcode
+])
+
+call_ops = dict.fromkeys([opcode[name] for name in '''CALL_FUNCTION
+    CALL_FUNCTION_VAR CALL_FUNCTION_KW CALL_FUNCTION_VAR_KW'''.split()
+    if name in opcode
+])
+
 class NotAConstant(Exception):
     """The supplied value is not a constant expression tree"""
 
@@ -1240,15 +3324,61 @@ def const_value(value):
     """
     t = type(value)
     if t is Const:
-        value = value.value
-    elif t is tuple:
-        t = tuple(map(const_value,value))
-        if t==value:
-            return value
-        return t
-    elif generate_types.get(t) != Code.LOAD_CONST:
-        raise NotAConstant(value)
-    return value
+        return value.value
+    elif t is not tuple:
+        if generate_types.get(t) != Code.LOAD_CONST:
+            raise NotAConstant(value)
+        return value
+    memo = {}   # id(tuple) -> its constant value
+    todo = [value]
+    while todo:
+        ob = todo[-1]
+        if id(ob) in memo:
+            todo.pop()
+            continue
+        missing = [
+            item for item in ob if type(item) is tuple and id(item) not in memo
+        ]
+        if missing:
+            todo.extend(missing)
+            continue
+        items = []
+        for item in ob:
+            t = type(item)
+            if t is tuple:
+                item = memo[id(item)]
+            elif t is Const:
+                item = item.value
+            elif generate_types.get(t) != Code.LOAD_CONST:
+                raise NotAConstant(item)
+            items.append(item)
+        memo[id(ob)] = ob
+        for old, new in zip(ob, items):
+            if old is not new:
+                memo[id(ob)] = tuple(items)
+                break
+        todo.pop()
+    return memo[id(value)]
+
+def is_const(value):
+    """Is `value` a constant expression tree?"""
+    try:
+        const_value(value)
+    except NotAConstant:
+        return False
+    return True
+
+def const_truth(value):
+    """Return the truth of an immutable constant expression tree
+
+    Raises NotAConstant if the value is not a constant, or if its truth could
+    change at runtime (e.g. because it's a list or other mutable object).
+    """
+    value = const_value(value)
+    t = type(value)
+    if t is tuple or t is frozenset or generate_types.get(t)==Code.LOAD_CONST:
+        return not not value
+    raise NotAConstant(value)
 
 
 def fold_args(f, *args):
@@ -1269,23 +3399,614 @@ def fold_args(f, *args):
 
 
 
+try:
+    from sys import getsizeof
+except ImportError:     # Python <2.6
+    getsizeof = lambda ob: 0
+
+def sizeof(ob):
+    """Approximate number of bytes freed if `ob` were discarded"""
+    if type(ob) is CodeType:
+        return sum(map(getsizeof, [
+            ob, ob.co_code, ob.co_lnotab, ob.co_consts, ob.co_names,
+            ob.co_varnames
+        ]))
+    return getsizeof(ob)
+
+interned_types = dict.fromkeys([tuple, str, unicode])
+try:
+    interned_types[frozenset] = True
+except NameError:       # Python 2.3
+    frozenset = None
+try:
+    interned_types[bytes] = True
+except NameError:       # Python <2.6
+    pass
+
+def const_key(value):
+    """Return a key that's equal only for interchangeable constant values
+
+    Unlike plain equality, the key distinguishes values of different types
+    (e.g. ``1`` vs. ``1.0`` vs. ``True``, even inside tuples), ``0.0`` from
+    ``-0.0``, and code objects with different filenames or line numbers.
+    ``TypeError`` is raised if the value (or any part of it) is unhashable.
+    """
+    if type(value) not in key_parts:
+        return leaf_key(value)
+    keys = {}   # id(tuple, frozenset, or code object) -> key
+    todo = [value]
+    while todo:
+        ob = todo[-1]
+        if id(ob) in keys:
+            todo.pop()
+            continue
+        t = type(ob)
+        parts = key_parts[t](ob)
+        missing = [
+            part for part in parts
+            if type(part) in key_parts and id(part) not in keys
+        ]
+        if missing:
+            todo.extend(missing)
+            continue
+        parts = [
+            type(part) in key_parts and keys[id(part)] or leaf_key(part)
+            for part in parts
+        ]
+        if t is frozenset:
+            keys[id(ob)] = t, frozenset(parts)
+        elif t is CodeType:
+            keys[id(ob)] = t, tuple(parts) + (
+                getattr(ob, 'co_kwonlyargcount', 0),
+            )
+        else:
+            keys[id(ob)] = t, tuple(parts)
+        todo.pop()
+    return keys[id(value)]
+
+def leaf_key(value):
+    """Return ``const_key(value)`` for a value that has no parts"""
+    t = type(value)
+    if t is float or t is complex:
+        return t, repr(value)
+    hash(value)
+    return t, value
+
+def tree_key(ob):
+    """Return a key that's equal only for interchangeable trees
+
+    Like ``const_key()``, the key distinguishes leaves (including the values
+    of ``Const()`` nodes) of different types, so that e.g. ``Return(1)``,
+    ``Return(True)``, and ``Return(1.0)`` all have different keys, even though
+    the trees are equal.  ``TypeError`` is raised if any leaf is unhashable.
+    """
+    keys = {}   # id(subtree) -> key
+    todo = [ob]
+    while todo:
+        node = todo[-1]
+        if id(node) in keys:
+            todo.pop()
+            continue
+        t = type(node)
+        if isinstance(node, Node) or t is tuple or t is list:
+            kids = children(node)
+            missing = [kid for kid in kids if id(kid) not in keys]
+            if missing:
+                todo.extend(missing)
+                continue
+            keys[id(node)] = (t,) + tuple([keys[id(kid)] for kid in kids])
+        elif t is Const:
+            keys[id(node)] = t, const_key(node.value)
+        else:
+            keys[id(node)] = const_key(node)
+        todo.pop()
+    return keys[id(ob)]
+
+key_parts = {
+    tuple: list,
+    frozenset: list,
+    CodeType: lambda code: [getattr(code, name) for name in (
+        'co_argcount', 'co_nlocals', 'co_stacksize', 'co_flags', 'co_code',
+        'co_consts', 'co_names', 'co_varnames', 'co_filename', 'co_name',
+        'co_firstlineno', 'co_lnotab', 'co_freevars', 'co_cellvars'
+    )],
+}
+
+
+class Interner(object):
+    """Registry of canonical code objects and large constants
+
+    Code objects are only weakly referenced, and constants are kept only as
+    long as a canonical code object that uses them is alive.  An interner can
+    be shared by code generated in several threads.
+    """
+
+    min_size = 128      # smallest constant (in bytes) that's worth interning
+
+    def __init__(self, min_size=None):
+        if min_size is not None:
+            self.min_size = min_size
+        self.codes = {}     # key -> weakref to canonical code object
+        self.consts = {}    # key -> [canonical value, number of users]
+        self.hits = 0
+        self.bytes_saved = 0
+        self.lock = threading.RLock()   # reentrant, for weakref callbacks
+
+    def const(self, value):
+        """Return the canonical equivalent of `value`, if it's worth interning"""
+        if type(value) not in interned_types or getsizeof(value)<self.min_size:
+            return value
+        try:
+            key = const_key(value)
+        except TypeError:
+            return value
+        self.lock.acquire()
+        try:
+            return self._const(key, value)
+        finally:
+            self.lock.release()
+
+    def _const(self, key, value):
+        entry = self.consts.get(key)
+        if entry is None:
+            self.consts[key] = [value, 0]
+        elif entry[0] is not value:
+            self.hits += 1
+            self.bytes_saved += sizeof(value)
+            return entry[0]
+        return value
+
+    def code(self, code):
+        """Return the canonical equivalent of code object `code`"""
+        self.lock.acquire()
+        try:
+            return self._code(code)
+        finally:
+            self.lock.release()
+
+    def _code(self, code):
+        keys = []
+        for c in code.co_consts:
+            if type(c) in interned_types and getsizeof(c)>=self.min_size:
+                try:
+                    key = const_key(c)
+                except TypeError:
+                    continue
+                entry = self.consts.get(key)
+                if entry is not None and entry[0] is c:
+                    keys.append(key)
+        try:
+            key = const_key(code)
+        except TypeError:
+            self._release(keys, 0)
+            return code
+
+        ref = self.codes.get(key)
+        if ref is not None:
+            canonical = ref()
+            if canonical is not None:
+                self._release(keys, 0)
+                self.hits += 1
+                self.bytes_saved += sizeof(code)
+                return canonical
+
+        for k in keys:
+            self.consts[k][1] += 1
+
+        def forget(ref, key=key, keys=keys):
+            self.lock.acquire()
+            try:
+                if self.codes.get(key) is ref:
+                    del self.codes[key]
+                self._release(keys, 1)
+            finally:
+                self.lock.release()
+
+        self.codes[key] = weakref.ref(code, forget)
+        return code
+
+    def _release(self, keys, count):
+        # Drop `count` users from each constant, forgetting unused ones
+        for key in keys:
+            entry = self.consts.get(key)
+            if entry is not None:
+                entry[1] -= count
+                if not entry[1]:
+                    del self.consts[key]
+
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:     # Python <3.4
+    asyncio = ThreadPoolExecutor = None
+
+try:
+    from time import perf_counter as timer
+except ImportError:     # Python <3.3
+    from time import time as timer
+
+class CodeService(object):
+    """Assemble code objects and functions in an executor, for ``asyncio``
+
+    ``code()`` and ``function()`` return awaitables, so that assembling large
+    trees doesn't block the event loop.  Concurrent requests for equal trees
+    (i.e., with equal ``key()`` values) share a single build.  They need
+    ``asyncio``, but ``key()`` and ``build()`` work on any Python version.
+    """
+
+    recent = 100    # how many build latencies to keep for ``metrics()``
+
+    def __init__(self, executor=None, parent=None):
+        if executor is None and ThreadPoolExecutor is not None:
+            executor = ThreadPoolExecutor(1)
+        if parent is None:
+            parent = Code()
+        self.executor = executor
+        self.parent = parent    # code is built with ``parent.nested()``
+        self.pending = {}       # key -> future, for builds in progress
+        self.lock = threading.Lock()
+        self.queued = self.running = self.builds = self.coalesced = 0
+        self.latencies = []
+
+    def code(self, body, name='<lambda>', args=(), var=None, kw=None):
+        """Return an awaitable code object for a function with `body`"""
+        if asyncio is None:
+            raise ImportError("CodeService requires asyncio")
+        key = self.key(body, name, args, var, kw)
+        future = None
+        if key is not None:
+            future = self.pending.get(key)
+        if future is None:
+            future = self.submit(key, body, name, args, var, kw)
+        else:
+            self.coalesced += 1
+        return asyncio.shield(future)
+
+    def function(self, body, name='<lambda>', args=(), var=None, kw=None,
+        defaults=(), globals=None
+    ):
+        """Return an awaitable function with `body`, `defaults`, `globals`"""
+        if globals is None:
+            globals = {'__builtins__': __builtins__}
+        code = self.code(body, name, args, var, kw)
+        result = asyncio.Future()
+        def done(code):
+            if result.cancelled():
+                return
+            elif code.cancelled():
+                result.cancel()
+            elif code.exception() is not None:
+                result.set_exception(code.exception())
+            else:
+                result.set_result(
+                    function(code.result(), globals, name, tuple(defaults) or None)
+                )
+        code.add_done_callback(done)
+        return result
+
+    def key(self, body, name='<lambda>', args=(), var=None, kw=None):
+        """Return the key that requests for equal trees share, or ``None``
+
+        ``None`` is returned for a tree that can't be hashed, so that it's
+        always built separately.
+        """
+        try:
+            key = tree_key(body), name, ntuple(args), var, kw
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def submit(self, key, *spec):
+        """Start building `spec` in the executor, sharing it under `key`"""
+        self.lock.acquire()
+        try:
+            self.queued += 1
+        finally:
+            self.lock.release()
+        future = asyncio.wrap_future(
+            self.executor.submit(self.build, timer(), *spec)
+        )
+        if key is not None:
+            self.pending[key] = future
+            def forget(future):
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+            future.add_done_callback(forget)
+        return future
+
+    def build(self, submitted, body, name, args, var, kw):
+        """Assemble a code object (called in the executor)"""
+        self.lock.acquire()
+        try:
+            self.queued -= 1
+            self.running += 1
+        finally:
+            self.lock.release()
+        try:
+            c = self.parent.nested(name, args, var, kw)
+            c(body)
+            if c.stack_size is not None:
+                c.return_()
+            return c.code()
+        finally:
+            latency = timer() - submitted
+            self.lock.acquire()
+            try:
+                self.running -= 1
+                self.builds += 1
+                self.latencies.append(latency)
+                del self.latencies[:-self.recent]
+            finally:
+                self.lock.release()
+
+    def metrics(self):
+        """Return a dictionary of queue depth, counts, and recent latencies"""
+        latencies = self.latencies[:]
+        mean = worst = None
+        if latencies:
+            mean, worst = sum(latencies)/len(latencies), max(latencies)
+        return dict(
+            queued = self.queued,           # submitted, but not started
+            running = self.running,
+            pending = len(self.pending),    # distinct trees being built
+            builds = self.builds,
+            coalesced = self.coalesced,     # requests that shared a build
+            latency_mean = mean,        # None if nothing's been built yet
+            latency_max = worst,
+        )
+
+
+class BuildGraph(object):
+    """Cache of generated code objects, regenerated only when inputs change
+
+    Each output is a code object built under a key from a tree, and the graph
+    records the fingerprints of every subtree (and ``Const()`` or ``Global()``
+    leaf) it was built from.  Asking again for an output with an equal tree
+    returns the cached code; ``invalidate()`` marks the outputs built from a
+    given subtree as stale, so that only they are regenerated.
+    """
+
+    def __init__(self, parent=None):
+        if parent is None:
+            parent = Code()
+        self.parent = parent    # code is built with ``parent.nested()``
+        self.outputs = {}   # key -> [fingerprint, code or None, spec, deps]
+        self.ids = {}       # structure -> fingerprint
+        self.structures = {}    # fingerprint -> (structure, leaf value)
+        self.users = {}     # fingerprint -> {key: True} for outputs using it
+        self.last = 0       # last fingerprint assigned
+        self.builds = self.reuses = 0
+
+    def code(self, key, body, name='<lambda>', args=(), var=None, kw=None):
+        """Return the code object for output `key`, built from `body`"""
+        spec = body, name, ntuple(args), var, kw
+        entry = self.outputs.get(key)
+        fingerprint, deps = self.fingerprint(spec)
+        if entry is not None and entry[1] is not None and \
+            entry[0]==fingerprint:
+            entry[2] = spec
+            self.reuses += 1
+            return entry[1]
+        self.record(key, [fingerprint, None, spec, deps])
+        try:
+            c = self.parent.nested(name, args, var, kw)
+            c(body)
+            if c.stack_size is not None:
+                c.return_()
+            code = c.code()
+        except:
+            self.record(key, None)
+            raise
+        self.outputs[key][1] = code
+        self.builds += 1
+        return code
+
+    def function(self, key, body, name='<lambda>', args=(), var=None, kw=None,
+        defaults=(), globals=None
+    ):
+        """Return a function for output `key`, with `defaults` and `globals`"""
+        if globals is None:
+            globals = {'__builtins__': __builtins__}
+        code = self.code(key, body, name, args, var, kw)
+        return function(code, globals, name, tuple(defaults) or None)
+
+    def invalidate(self, ob):
+        """Mark the outputs built from subtree `ob` stale; return their keys"""
+        fingerprint = self.fingerprint(ob, False)[0]
+        keys = list(self.users.get(fingerprint, ()))
+        for key in keys:
+            self.outputs[key][1] = None
+        return keys
+
+    def rebuild(self):
+        """Regenerate the stale outputs, returning a ``{key: code}`` dictionary"""
+        return dict([
+            (key, self.code(key, *entry[2]))
+            for key, entry in list(self.outputs.items()) if entry[1] is None
+        ])
+
+    def forget(self, key):
+        """Remove output `key` from the graph"""
+        self.record(key, None)
+
+    def record(self, key, entry):
+        # Replace the entry for `key`, updating the users of its fingerprints
+        old = self.outputs.pop(key, None)
+        new = {}
+        if entry is not None:
+            self.outputs[key] = entry
+            for fingerprint in entry[3]:
+                new[fingerprint] = True
+                self.users.setdefault(fingerprint, {})[key] = True
+        if old is not None:
+            for fingerprint in old[3]:
+                if fingerprint in new:
+                    continue
+                users = self.users[fingerprint]
+                del users[key]
+                if not users:   # no output uses it, so forget it entirely
+                    del self.users[fingerprint]
+                    structure, value = self.structures.pop(fingerprint)
+                    del self.ids[structure]
+
+    def fingerprint(self, ob, add=True):
+        """Return `ob`'s fingerprint and a list of those of all its subtrees
+
+        Equal trees have the same fingerprint, and each fingerprint is a small
+        integer, computed from those of a subtree's children.  Leaves (and the
+        values of ``Const()`` nodes) are compared using ``const_key()``, so
+        equal values of different types get different fingerprints, and ones
+        that can't be hashed are compared by identity.  If `add` is false, the
+        fingerprint of a subtree the graph hasn't seen is ``None``.
+        """
+        memo = {}   # id(subtree) -> fingerprint
+        ids = self.ids
+        todo = [ob]
+        while todo:
+            node = todo[-1]
+            if id(node) in memo:
+                todo.pop()
+                continue
+            value = None
+            if type(node) is Const:
+                try:
+                    structure = Const, const_key(node.value)
+                except TypeError:
+                    structure = Const, id(node.value)
+                value = node.value      # kept alive by `structures`
+            elif isinstance(node, Node) or type(node) is tuple or \
+                type(node) is list:
+                kids = children(node)
+                missing = [kid for kid in kids if id(kid) not in memo]
+                if missing:
+                    todo.extend(missing)
+                    continue
+                structure = (type(node),) + tuple([memo[id(kid)] for kid in kids])
+            else:
+                try:
+                    structure = const_key(node)
+                except TypeError:
+                    structure = id(node)    # kept alive by `structures`
+                value = node
+            todo.pop()
+            fingerprint = ids.get(structure)
+            if fingerprint is None and add:
+                self.last = fingerprint = self.last + 1
+                ids[structure] = fingerprint
+                self.structures[fingerprint] = structure, value
+            memo[id(node)] = fingerprint
+        deps = dict.fromkeys(memo.values())
+        deps.pop(None, None)
+        return memo[id(ob)], list(deps)
+
+
+nodetype()
+def Slot(name, code=None):
+    """A named placeholder constant, filled in by a ``Template``"""
+    if code is None:
+        return name,
+    return code.LOAD_CONST(Slot(name))
+
+class Template(object):
+    """A function body assembled once, whose ``Slot()`` constants vary
+
+    ``code()`` and ``function()`` make a copy of the assembled code object with
+    the slots replaced by values, without generating any code.
+    """
+
+    def __init__(self, body, name='<lambda>', args=(), var=None, kw=None,
+        parent=None
+    ):
+        if parent is None:
+            parent = Code()
+        c = parent.nested(name, args, var, kw)
+        c(body)
+        if c.stack_size is not None:
+            c.return_()
+        self.name = name
+        self.template = c.code()
+        self.plan = slot_plan(self.template)
+        self.slots = []
+        todo = [self.plan]
+        while todo:
+            for index, name, plan in todo.pop():
+                if plan is None:
+                    if name not in self.slots:
+                        self.slots.append(name)
+                else:
+                    todo.append(plan)
+
+    def code(self, values):
+        """Return a code object with `values` (a mapping) in the slots"""
+        return fill_slots(self.template, self.plan, values)
+
+    def function(self, values, globals=None, defaults=()):
+        """Return a function with `values` in the slots"""
+        if globals is None:
+            globals = {'__builtins__': __builtins__}
+        return function(
+            self.code(values), globals, self.name, tuple(defaults) or None
+        )
+
+def slot_plan(code):
+    """Return ``(index, name, plan)`` for each slot in `code`'s constants
+
+    `name` is ``None`` for a nested code object with slots; its `plan` is then
+    the plan for that code object.  (Otherwise, `plan` is ``None``.)
+    """
+    plan = []
+    for index, const in enumerate(code.co_consts):
+        if type(const) is Slot:
+            plan.append((index, const.name, None))
+        elif type(const) is CodeType:
+            nested = slot_plan(const)
+            if nested:
+                plan.append((index, None, nested))
+    return plan
+
+def fill_slots(code, plan, values):
+    """Copy `code`, replacing the constants in `plan` using `values`"""
+    if not plan:
+        return code
+    consts = list(code.co_consts)
+    for index, name, nested in plan:
+        if nested is None:
+            consts[index] = values[name]
+        else:
+            consts[index] = fill_slots(consts[index], nested, values)
+    new = NEW_CODE(
+        code.co_argcount, code.co_nlocals, code.co_stacksize, code.co_flags,
+        code.co_code, tuple(consts), code.co_names, code.co_varnames,
+        code.co_filename, code.co_name, code.co_firstlineno, code.co_lnotab,
+        code.co_freevars, code.co_cellvars
+    )
+    copy_offsets(code, new)
+    return new
+
+
 def iter_code(codestring):
     """Iterate over a code string, yielding (start,op,arg,jump,end) tuples
 
     `start` is the position of the operation start, `end` is the position of
     the next operation start.  `jump` is a jump target or ``None`` if `op`
     isn't a jump.  `op` is the opcode, and `arg` the argument, with 32-bit
-    ``EXTENDED_ARG`` instructions pre-processed.
+    ``EXTENDED_ARG`` instructions pre-processed.  (For an instruction with an
+    ``EXTENDED_ARG`` prefix, `start` is the position of the prefix.)  The code
+    string may be a string or a ``Code`` object's ``co_code`` byte array.
     """
+    if not isinstance(codestring, array):
+        codestring = array('B', codestring)
     start = ptr = 0
     size = len(codestring)
     extend = 0
     while ptr < size:
-        op = ord(codestring[ptr])
+        op = codestring[ptr]
         ptr += 1
         if op>=HAVE_ARGUMENT:
-            arg = ord(codestring[ptr]) + ord(codestring[ptr+1])*256 + extend
-            extended_arg = 0
+            arg = codestring[ptr] + codestring[ptr+1]*256 + extend
+            extend = 0
             ptr += 2
             if op == EXTENDED_ARG:
                 extend = arg*long(65536)
@@ -1299,6 +4020,312 @@ def iter_code(codestring):
         yield start, op, arg, jump, ptr
         start = ptr
 
+def set_arg(codestring, offset, wide, arg):
+    """Overwrite the argument of the instruction at `offset` in a byte array
+
+    If `wide` is true, the instruction has an ``EXTENDED_ARG`` prefix, whose
+    argument is set to the high 16 bits of `arg` (which may be zero).
+    """
+    codestring[offset+1] = arg & 255
+    codestring[offset+2] = (arg>>8) & 255
+    if wide:
+        codestring[offset-2] = (arg>>16) & 255
+        codestring[offset-1] = (arg>>24) & 255
+
+def relocate(codestring, edits):
+    """Apply `edits` to a code string, returning a new ``(code, where)`` pair
+
+    `edits` maps instruction start offsets to sequences of replacement bytes,
+    which must not be longer than the instructions they replace.  (An empty
+    sequence deletes the instruction.)  Jump arguments are adjusted to point
+    to the new locations; a jump to a deleted instruction goes to whatever
+    instruction now follows it.  `where` maps each old instruction offset
+    (and the old code length) to the corresponding new offset.
+    """
+    old = codestring
+    if not isinstance(old, array):
+        old = array('B', old)
+    code = array('B')
+    where = {}
+    jumps = []
+    for start, op, arg, jump, end in iter_code(old):
+        where[start] = len(code)
+        if start in edits:
+            code.extend(array('B', edits[start]))
+        else:
+            code.extend(old[start:end])
+            if jump is not None:
+                jumps.append((len(code), op, jump, end-start>3))
+    where[len(old)] = len(code)
+    for end, op, jump, wide in jumps:
+        target = where[jump]
+        if op in hasjrel:
+            target -= end
+        set_arg(code, end-3, wide, target)
+    return code, where
+
+def verify(code):
+    """Check a code object's stack levels, jumps, blocks, and arguments
+
+    The code (or a function's code) is checked in a single pass, using the
+    same model of stack effects and blocks as ``Code``.  Jumps must go to the
+    start of an instruction, with the same stack level and blocks as every
+    other path there; the stack must never underflow or exceed
+    ``co_stacksize``; ``POP_BLOCK`` must be inside a block, and ``BREAK_LOOP``
+    and ``CONTINUE_LOOP`` inside a loop; constant, name, and variable indexes
+    must be in range; and execution must not run past the end of the code
+    (an ``END_FINALLY`` that ends a chain of ``except`` clauses re-raises, and
+    ``CONTINUE_LOOP`` unwinds the stack to its loop's level).  Unreachable code
+    is skipped.  ``AssertionError`` is raised for the first
+    problem found.
+    """
+    if not isinstance(code, CodeType):
+        code = getattr(code, CODE)
+    instructions = list(iter_code(code.co_code))
+    starts = dict.fromkeys([start for start, op, arg, jump, end in instructions])
+    limits = {}
+    for ops, seq in (
+        (hasconst, code.co_consts), (hasname, code.co_names),
+        (haslocal, code.co_varnames), (hasfree, code.co_cellvars+code.co_freevars)
+    ):
+        for op in ops:
+            limits[op] = len(seq)
+
+    def arrive(offset, level, blocks, handler):
+        if offset not in seen:
+            seen[offset] = level, blocks, handler
+            return
+        expected, expected_blocks, expected_handler = seen[offset]
+        if level != expected:
+            raise AssertionError(
+                "Stack level mismatch: actual=%s expected=%s" % (level, expected),
+                offset
+            )
+        elif blocks is not None and blocks != expected_blocks:
+            raise AssertionError("Block mismatch", offset)
+        elif handler != expected_handler:
+            seen[offset] = expected, expected_blocks, None
+
+    # offset -> (stack level, blocks, handler) on arrival; `handler` is the
+    # stack level an exception handler started at, while it still has the
+    # exception on the stack (an END_FINALLY there re-raises it)
+    seen = {}
+    depth, blocks, handler = 0, (), None    # blocks: tuple of (op, level)
+    for start, op, arg, jump, end in instructions:
+        if depth is None:
+            if start not in seen:
+                continue    # unreachable
+            depth, blocks, handler = seen[start]
+        else:
+            arrive(start, depth, blocks, handler)
+        if op in limits and arg >= limits[op]:
+            raise AssertionError("Argument out of range", start, opname[op])
+        inputs, outputs = stack_effect(op, arg)
+        if inputs > depth:
+            raise AssertionError("Stack underflow", start)
+        level = depth
+        depth += outputs - inputs
+        reraise = op==END_FINALLY and level==handler    # no except matched
+        if handler is not None and depth < handler:
+            handler = None      # exception has been removed from the stack
+        target = peak = depth
+        if op==FOR_ITER:
+            target, depth = depth-1, depth+1
+            peak = depth
+        elif op==JUMP_IF_TRUE_OR_POP or op==JUMP_IF_FALSE_OR_POP:
+            depth -= 1
+        elif op==SETUP_EXCEPT:
+            target = peak = depth+3
+        elif op==SETUP_FINALLY:
+            target, peak = depth+1, depth+3
+        elif opname[op]=='SETUP_WITH':
+            peak = depth+2      # the exception replaces __enter__'s result
+        if peak > code.co_stacksize:
+            raise AssertionError("Stack size exceeds co_stacksize", start)
+        if jump is not None:
+            if jump not in starts:
+                raise AssertionError("Jump to invalid offset", start, jump)
+            if jump<=start and jump not in seen or op==CONTINUE_LOOP and \
+                jump not in seen:
+                raise AssertionError("Jump to unreachable code", start, jump)
+            if op==CONTINUE_LOOP:
+                # leaves blocks, unwinding the stack to the loop's level
+                expected = seen[jump][0]
+                loops = [base for why, base in blocks if why==SETUP_LOOP]
+                if loops and not loops[-1] <= expected <= target:
+                    raise AssertionError(
+                        "Stack level mismatch: actual=%s expected=%s"
+                        % (target, expected), jump
+                    )
+            elif op==SETUP_EXCEPT:
+                arrive(jump, target, blocks, target)
+            else:
+                arrive(jump, target, blocks, handler)
+        if op in block_ops:
+            blocks += (op, level),
+        elif op==POP_BLOCK:
+            if not blocks:
+                raise AssertionError("Not currently in a block", start)
+            if blocks[-1][0]==SETUP_EXCEPT:
+                depth = blocks[-1][1]   # stack level resets here
+            blocks = blocks[:-1]
+        elif op==BREAK_LOOP or op==CONTINUE_LOOP:
+            if SETUP_LOOP not in [why for why, level in blocks]:
+                raise AssertionError("Not inside a loop", start)
+        if op in terminal_ops or reraise:
+            depth = None
+    if depth is not None:
+        raise AssertionError("Code can run past its end")
+
+def stack_effect(op, arg=None):
+    """Return the ``(inputs, outputs)`` of opcode `op` with argument `arg`
+
+    Jumps' effects are for the path that doesn't jump, except for ``FOR_ITER``
+    and ``JUMP_IF_*_OR_POP`` instructions, which ``verify()`` adjusts.
+    """
+    name = opname[op]
+    if name in counted_ops:
+        return counted_ops[name](arg)
+    elif name.startswith('CALL_FUNCTION'):
+        return 1 + (arg & 255) + 2*(arg >> 8) + name.count('VAR') + \
+            name.count('KW'), 1
+    return stack_effects[op]
+
+counted_ops = dict(
+    BUILD_TUPLE = lambda n: (n, 1),
+    BUILD_LIST = lambda n: (n, 1),
+    BUILD_LIST_UNPACK = lambda n: (n, 1),
+    BUILD_SET = lambda n: (n, 1),
+    UNPACK_SEQUENCE = lambda n: (1, n),
+    BUILD_SLICE = lambda n: (n, 1),
+    DUP_TOPX = lambda n: (n, n*2),
+    RAISE_VARARGS = lambda n: (n, 0),
+    MAKE_FUNCTION = lambda n: (1+n, 1),
+    MAKE_CLOSURE = lambda n: (1+(sys.version>='2.5')+n, 1),
+)
+if 'LIST_APPEND' in opcode and LIST_APPEND>=HAVE_ARGUMENT:
+    counted_ops['LIST_APPEND'] = lambda n: (n+1, n)
+    counted_ops['SET_ADD'] = lambda n: (n+1, n)
+    counted_ops['MAP_ADD'] = lambda n: (n+2, n)
+
+block_ops = dict.fromkeys([opcode[name] for name in
+    'SETUP_LOOP SETUP_EXCEPT SETUP_FINALLY SETUP_WITH'.split()
+    if name in opcode
+])
+
+terminal_ops = dict.fromkeys([opcode[name] for name in '''JUMP_FORWARD
+    JUMP_ABSOLUTE CONTINUE_LOOP RETURN_VALUE RAISE_VARARGS BREAK_LOOP'''.split()
+    if name in opcode
+])
+
+def make_lnotab(lines, firstlineno=0):
+    """Encode a sequence of ``(offset, line)`` pairs as a line number table
+
+    Line numbers can only decrease on Python versions whose line number
+    tables have signed line increments (3.6 and up); elsewhere, a step back
+    to an earlier line is left out of the table.
+    """
+    lnotab = array('B')
+    append = lnotab.append
+    last_addr, last_line = 0, firstlineno
+    for addr, line in lines:
+        incr_line = line - last_line
+        incr_addr = addr - last_addr
+        if not incr_line or incr_line<0 and not SIGNED_LNOTAB:
+            continue
+
+        assert incr_addr>=0
+
+        while incr_addr>255:
+            append(255)
+            append(0)
+            incr_addr -= 255
+
+        while incr_line>MAX_LINE_INCR or incr_line<-128:
+            step = incr_line>0 and MAX_LINE_INCR or -128
+            append(incr_addr)
+            append(step & 255)
+            incr_line -= step
+            incr_addr = 0
+
+        if incr_addr or incr_line:
+            append(incr_addr)
+            append(incr_line & 255)
+
+        last_addr, last_line = addr, line
+    return lnotab
+
+SIGNED_LNOTAB = sys.version_info >= (3, 6)
+MAX_LINE_INCR = SIGNED_LNOTAB and 127 or 255
+
+source_spans = {}   # id(code) -> (weakref to code, offsets, spans)
+node_origins = {}   # id(code) -> (weakref to code, offsets, nodes)
+
+def register_offsets(registry, code, pairs):
+    """Save ``(offset, value)`` pairs for `code` in `registry`"""
+    remember_offsets(
+        registry, code, array('l', [ofs for ofs, value in pairs]),
+        tuple([value for ofs, value in pairs])
+    )
+
+def remember_offsets(registry, code, offsets, values):
+    key = id(code)
+    def forget(ref):
+        if registry.get(key, (None,))[0] is ref:
+            del registry[key]
+    registry[key] = weakref.ref(code, forget), offsets, values
+
+def has_offsets(registry, code):
+    """Does `registry` have offsets for `code`?"""
+    entry = registry.get(id(code))
+    return entry is not None and entry[0]() is code
+
+def copy_offsets(old, new):
+    """Give code object `new` the same spans and origins as `old`"""
+    for registry in source_spans, node_origins:
+        entry = registry.get(id(old))
+        if entry is not None and entry[0]() is old:
+            remember_offsets(registry, new, entry[1], entry[2])
+
+def lookup_offset(registry, code, offset):
+    """Return the `registry` value in effect at `offset` in `code`, if any"""
+    code = getattr(code, FUNC, code)
+    code = getattr(code, CODE, code)
+    entry = registry.get(id(code))
+    if entry is None or entry[0]() is not code:
+        return None
+    pos = bisect_right(entry[1], offset) - 1
+    if pos>=0:
+        return entry[2][pos]
+
+def register_spans(code, spans):
+    """Record ``(offset, span)`` pairs for lookup with ``source_span()``"""
+    register_offsets(source_spans, code, spans)
+
+def register_origins(code, origins):
+    """Record ``(offset, node)`` pairs for lookup with ``source_node()``"""
+    register_offsets(node_origins, code, origins)
+
+def source_span(code, offset):
+    """Return the source span that was in effect at `offset` in `code`
+
+    `code` can be a function, method, or code object, and `offset` an
+    instruction offset such as a traceback's ``tb_lasti``.  The result is
+    whatever `span` was last passed to ``Code.set_lineno()`` before the
+    instruction was generated, or ``None``.
+    """
+    return lookup_offset(source_spans, code, offset)
+
+def source_node(code, offset):
+    """Return the innermost node that generated the instruction at `offset`
+
+    `code` can be a function, method, or code object, and `offset` an
+    instruction offset such as a frame's ``f_lasti``.  ``None`` is returned if
+    the instruction wasn't generated by a node, or if the code wasn't generated
+    with ``record_origins`` set.
+    """
+    return lookup_offset(node_origins, code, offset)
+
 argtype = {}
 for name, group in dict(
     co_consts = hasconst,
@@ -1310,44 +4337,76 @@ for name, group in dict(
     for op in group:
         argtype[op] = name
 
-def dump(code):
-    """Disassemble code in a symbolic manner, i.e., without offsets"""
+def iter_symbolic(code):
+    """Lazily yield ``(label, opname, arg, symbol)`` tuples for `code`
+
+    `code` may be a function, method, code object, or ``Code`` instance.
+    `label` is the instruction's label name (e.g. ``'L1'``) if it's a jump
+    target, otherwise ``None``.  `arg` is the numeric argument (or ``None``),
+    and `symbol` is what the argument refers to: a jump target's label name,
+    or the referenced constant, name, or comparison operator (else ``None``).
+    """
     code = getattr(code, FUNC, code)
     code = getattr(code, CODE, code)
-    co_names = code.co_names
-    co_consts = [repr(x) for x in code.co_consts]
-    co_varnames = code.co_varnames
-    cmp_ops = cmp_op
-    free = code.co_cellvars + code.co_freevars
+    codestring = array('B', code.co_code)
+    targets = {}
+    for start, op, arg, jump, end in iter_code(codestring):
+        if jump is not None:
+            targets[jump] = 1
+    targets = list(targets)
+    targets.sort()
     labels = {}
-    instructions = list(iter_code(code.co_code))
-    lbl = [jump for start, op, arg, jump, end in instructions if jump is not None]
-    lbl.sort()
-    for jump in lbl:
-        labels.setdefault(jump, "L%d:" % (len(labels)+1))
-
-    i = 0
-    while i<len(instructions):
-        start, op, arg, jump, end = instructions[i]
-        ln = '        '+labels.get(start, '').ljust(7)
-        if op==DUP_TOP and instructions[i+1][1] in (POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE):
-            s, op, arg, jump, end = instructions[i+1]
-            ln+=' '+['JUMP_IF_FALSE', 'JUMP_IF_TRUE'][op==POP_JUMP_IF_TRUE].ljust(15)
-            i+=1
-        elif op in (JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP):
-            ln += ' ' + opname[op][:-7].ljust(15)
-        else:
-            ln += ' ' + opname[op].ljust(15)
+    for jump in targets:
+        labels[jump] = "L%d" % (len(labels)+1)
+
+    tables = dict(
+        co_consts = code.co_consts, co_names = code.co_names,
+        co_varnames = code.co_varnames, cmp_ops = cmp_op,
+        free = tuple(code.co_cellvars) + tuple(code.co_freevars),
+    )
+    for start, op, arg, jump, end in iter_code(codestring):
         if jump is not None:
-            ln += ' ' + labels[jump][:-1].rjust(10)
-        elif arg is not None:
-            ln += ' ' + repr(arg).rjust(10)
-            if op in argtype:
-                ln += ' (%s)' % (locals()[argtype[op]][arg])
-        print(ln)
-        if op in (JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP):
-            print('        '+''.ljust(7) + ' POP_TOP')
-        i+=1
+            symbol = labels[jump]
+        elif op in argtype:
+            symbol = tables[argtype[op]][arg]
+        else:
+            symbol = None
+        yield labels.get(start), opname[op], arg, symbol
+
+def dump(code):
+    """Disassemble code in a symbolic manner, i.e., without offsets"""
+    held = None     # label of a DUP_TOP that may start a JUMP_IF_* emulation
+    for label, name, arg, symbol in iter_symbolic(code):
+        if held is not None:
+            if name in ('POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE'):
+                label, name = held[0], name[4:]
+            else:
+                print(format_instruction(held[0], 'DUP_TOP', None, None))
+            held = None
+        if name=='DUP_TOP':
+            held = label,
+            continue
+        if name in ('JUMP_IF_TRUE_OR_POP', 'JUMP_IF_FALSE_OR_POP'):
+            print(format_instruction(label, name[:-7], arg, symbol))
+            print(format_instruction(None, 'POP_TOP', None, None))
+        else:
+            print(format_instruction(label, name, arg, symbol))
+    if held is not None:
+        print(format_instruction(held[0], 'DUP_TOP', None, None))
+
+def format_instruction(label, name, arg, symbol):
+    """Format an ``iter_symbolic()`` tuple as a line of ``dump()`` output"""
+    ln = '        ' + (label and label+':' or '').ljust(7) + ' ' + name.ljust(15)
+    op = opcode.get(name)
+    if op in hasjrel or op in hasjabs or name.startswith('JUMP_IF_'):
+        ln += ' ' + symbol.rjust(10)
+    elif arg is not None:
+        ln += ' ' + repr(arg).rjust(10)
+        if op in hasconst:
+            ln += ' (%s)' % repr(symbol)
+        elif op in argtype:
+            ln += ' (%s)' % (symbol,)
+    return ln
 
 
 
@@ -1359,7 +4418,8 @@ class _se:
     ROT_FOUR  = 4,4
     DUP_TOP   = 1,2
     UNARY_POSITIVE = UNARY_NEGATIVE = UNARY_NOT = UNARY_CONVERT = \
-        UNARY_INVERT = GET_ITER = LOAD_ATTR = IMPORT_FROM = 1,1
+        UNARY_INVERT = GET_ITER = LOAD_ATTR = 1,1
+    IMPORT_FROM = 1,2
 
     BINARY_POWER = BINARY_MULTIPLY = BINARY_DIVIDE = BINARY_FLOOR_DIVIDE = \
         BINARY_TRUE_DIVIDE = BINARY_MODULO = BINARY_ADD = BINARY_SUBTRACT = \
@@ -1379,6 +4439,7 @@ class _se:
         (1,0),(2,0),(2,0),(3,0)
     
     STORE_SUBSCR = POP_EXCEPT = EXEC_STMT = 3,0
+    STORE_MAP = 3,1
     DELETE_SUBSCR = STORE_ATTR = 2,0
     DELETE_ATTR = STORE_DEREF = 1,0
     PRINT_EXPR = PRINT_ITEM = PRINT_NEWLINE_TO = IMPORT_STAR = 1,0
@@ -1394,6 +4455,9 @@ class _se:
 
 if sys.version>="2.5":
     _se.YIELD_VALUE = 1, 1
+    _se.IMPORT_NAME = 2, 1      # level and fromlist
+    _se.SETUP_WITH = 1, 2       # __exit__ and __enter__'s result
+    _se.WITH_CLEANUP = 2, 1     # __exit__ is removed from under the None
 
 stack_effects = [(0,0)]*256
 